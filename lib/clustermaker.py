@@ -4,7 +4,7 @@ from numba import njit
 
 import pairwise
 import common
-from common import Models, debug
+from common import Models, NUM_MODELS, debug
 from mutrel import Mutrel
 import util
 
@@ -19,12 +19,102 @@ def _check_clusters(variants, clusters, garbage):
   assert len(clustered & garbage) == 0
   assert set(vids) == (clustered | garbage)
 
-def use_pre_existing(variants, logprior, parallel, clusters, garbage):
+def use_pre_existing(variants, logprior, parallel, clusters, garbage, pairwise_args=None):
+  # `pairwise_args` holds any extra keyword arguments for
+  # `pairwise.calc_posterior` (e.g., which likelihood method to use).
+  if pairwise_args is None:
+    pairwise_args = {}
   supervars = make_cluster_supervars(clusters, variants)
-  clust_posterior, clust_evidence = pairwise.calc_posterior(supervars, logprior, rel_type='supervariant', parallel=parallel)
   _check_clusters(variants, clusters, garbage)
+
+  if pairwise_args.get('per_sample', False):
+    # Also return the per-sample evidence, so that it can be stored.
+    clust_posterior, clust_evidence, clust_evidence_per_sample = pairwise.calc_posterior(supervars, logprior, rel_type='supervariant', parallel=parallel, **pairwise_args)
+    return (supervars, clust_posterior, clust_evidence, clusters, garbage, clust_evidence_per_sample)
+
+  clust_posterior, clust_evidence = pairwise.calc_posterior(supervars, logprior, rel_type='supervariant', parallel=parallel, **pairwise_args)
   return (supervars, clust_posterior, clust_evidence, clusters, garbage)
 
+def use_aggregated(variants, logprior, parallel, clusters, garbage, variant_evidence, tol, pairwise_args=None):
+  # Like `use_pre_existing`, but starts from supervariant evidence approximated
+  # from the variant-level evidence in `variant_evidence` (e.g., as stored by
+  # `bin/removegarbage --pairwise-results`), refining only ambiguous pairs.
+  # Also returns a dict describing the refinement.
+  if pairwise_args is None:
+    pairwise_args = {}
+  supervars = make_cluster_supervars(clusters, variants)
+  _check_clusters(variants, clusters, garbage)
+
+  approx_evidence = pairwise.aggregate_evidence(variant_evidence, clusters, common.extract_vids(supervars))
+  clust_posterior, clust_evidence, stats = pairwise.calc_posterior_aggregated(supervars, logprior, 'supervariant', approx_evidence, tol, parallel=parallel, **pairwise_args)
+  return (supervars, clust_posterior, clust_evidence, clusters, garbage, stats)
+
+def use_variant_evidence(variants, logprior, parallel, clusters, garbage, variant_evidence, pairwise_args=None):
+  # Like `use_pre_existing`, but for clusters that each hold a single variant,
+  # such that each supervariant's relations are just those of its variant,
+  # which can be taken from the variant-level evidence in `variant_evidence`
+  # (e.g., as stored by `bin/removegarbage --pairwise-results`) with only
+  # `logprior` applied. This holds only if the variant has `omega_v = 0.5` in
+  # every sample, as the supervariant otherwise rescales its read counts, so
+  # pairs involving other variants are computed anew. `pairwise_args` holds
+  # any extra keyword arguments for `pairwise.calc_posterior_partial`.
+  if pairwise_args is None:
+    pairwise_args = {}
+  assert all([len(C) == 1 for C in clusters]), 'Variant evidence can be used only for singleton clusters'
+  supervars = make_cluster_supervars(clusters, variants)
+  _check_clusters(variants, clusters, garbage)
+
+  reusable = np.array([np.all(variants[C[0]]['omega_v'] == 0.5) for C in clusters])
+  known_evidence = pairwise.aggregate_evidence(variant_evidence, clusters, common.extract_vids(supervars))
+  known_evidence.rels[np.logical_not(reusable)] = np.nan
+  known_evidence.rels[:,np.logical_not(reusable)] = np.nan
+  clust_posterior, clust_evidence = pairwise.calc_posterior_partial(supervars, logprior, 'supervariant', known_evidence, parallel=parallel, **pairwise_args)
+  return (supervars, clust_posterior, clust_evidence, clusters, garbage)
+
+def hash_supervars(supervars):
+  '''Return the hash of each supervariant's read counts, ordered by
+  supervariant ID, so that a later run can tell whether its supervariants are
+  identical (see `use_previous`).'''
+  svids = common.extract_vids(supervars)
+  return [common.hash_variant(common.convert_variant_dict_to_tuple(supervars[S])).hex() for S in svids]
+
+def use_previous(variants, logprior, parallel, clusters, garbage, prev_clusters, prev_hashes, prev_evidence, pairwise_args=None):
+  # Like `use_pre_existing`, but reuses the supervariant evidence in
+  # `prev_evidence`, computed for the clusters in `prev_clusters` (e.g., by an
+  # earlier run of `bin/pairtree` before clusters were edited), whose
+  # supervariants had the hashes `prev_hashes` from `hash_supervars`. Clusters
+  # are matched by both their member sets and their supervariants' read counts,
+  # so only pairs involving a new or changed cluster, or a cluster whose
+  # variants' read counts changed, are computed. The caller must check that the
+  # previous evidence was computed with the same settings (see
+  # `pairwise.make_evidence_settings`). Also returns a dict counting the reused
+  # and recomputed pairs.
+  if pairwise_args is None:
+    pairwise_args = {}
+  supervars = make_cluster_supervars(clusters, variants)
+  _check_clusters(variants, clusters, garbage)
+  assert len(prev_clusters) == len(prev_hashes) == len(prev_evidence.vids)
+
+  prev_idxs = {(common.hash_members(C), H): idx for idx, (C, H) in enumerate(zip(prev_clusters, prev_hashes))}
+  matches = [prev_idxs.get((common.hash_members(C), H)) for C, H in zip(clusters, hash_supervars(supervars))]
+  reused = np.array([idx is not None for idx in matches])
+  svids = common.extract_vids(supervars)
+  K = len(svids)
+
+  known_evidence = Mutrel(vids=svids, rels=np.full((K, K, NUM_MODELS), np.nan))
+  prev_order = np.array([idx for idx in matches if idx is not None], dtype=int)
+  known_evidence.rels[np.ix_(reused, reused)] = prev_evidence.rels[np.ix_(prev_order, prev_order)]
+  clust_posterior, clust_evidence = pairwise.calc_posterior_partial(supervars, logprior, 'supervariant', known_evidence, parallel=parallel, **pairwise_args)
+
+  num_reused = np.sum(reused)
+  stats = {
+    'clusters_reused': int(num_reused),
+    'clusters_computed': int(K - num_reused),
+    'pairs_reused': int(num_reused*(num_reused - 1) // 2),
+    'pairs_computed': int(K*(K - 1) // 2 - num_reused*(num_reused - 1) // 2),
+  }
+  return (supervars, clust_posterior, clust_evidence, clusters, garbage, stats)
+
 # This code is currently unused. Perhaps I can implement a garbage-detection
 # algorithm in the future using it.
 def _discard_garbage(clusters, mutrel_posterior, mutrel_evidence):
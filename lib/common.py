@@ -1,4 +1,5 @@
 import numpy as np
+import hashlib
 from collections import namedtuple
 import warnings
 from scipy.cluster.hierarchy import ClusterWarning
@@ -24,6 +25,25 @@ def extract_vids(variants):
 def convert_variant_dict_to_tuple(V):
   return Variant(**{K: V[K] for K in Variant._fields})
 
+def hash_variant(V):
+  '''Hash the read counts of `Variant` `V`, which fully determine its pairwise
+  evidence with any other variant.'''
+  H = hashlib.sha1()
+  for arr, dtype in ((V.var_reads, np.int64), (V.ref_reads, np.int64), (V.omega_v, np.float64)):
+    H.update(np.ascontiguousarray(arr, dtype=dtype).tobytes())
+  return H.digest()
+
+def hash_variants(variants):
+  '''Hash the read counts of a list of `Variant`s, in order.'''
+  H = hashlib.sha1()
+  for V in variants:
+    H.update(hash_variant(V))
+  return H.hexdigest()
+
+def hash_members(vids):
+  '''Hash the set of variant IDs making up a cluster, regardless of order.'''
+  return hashlib.sha1(','.join(sort_vids(vids)).encode()).hexdigest()
+
 # An `IntEnum` would be cleaner, but it creates Numba problems, so use
 # `namedtuple` instead.
 _ModelChoice = namedtuple('_ModelChoice', (
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import sqlite3
+import time
+import numpy as np
+
+from common import NUM_MODELS
+import common
+from mutrel import SWAP_A_B
+
+# Bump this whenever the pairwise likelihood computation changes, so that
+# stale cached evidence is never used.
+CACHE_VERSION = 1
+# Approximate on-disk size of one entry, including the key and SQLite
+# overhead. Used to convert the size limit into a number of entries.
+_ENTRY_BYTES = 128
+# SQLite limits the number of parameters per query.
+_QUERY_BATCH = 500
+
+class EvidenceCache:
+  # Pairwise evidence is stored in an SQLite database within `cache_dir`, keyed
+  # by a hash of both variants' read counts and the likelihood method. SQLite
+  # handles locking, so multiple Pairtree runs can safely share a cache.
+  #
+  # Evidence is symmetric under swapping the variants (modulo exchanging A_B
+  # and B_A), so each unordered pair is stored only once.
+
+  def __init__(self, cache_dir, max_size_mb=1024, method='quad'):
+    os.makedirs(cache_dir, exist_ok=True)
+    self._db = sqlite3.connect(os.path.join(cache_dir, 'evidence.sqlite'), timeout=60)
+    self._db.execute('CREATE TABLE IF NOT EXISTS evidence (key BLOB PRIMARY KEY, rels BLOB NOT NULL, last_used REAL NOT NULL)')
+    self._db.execute('CREATE INDEX IF NOT EXISTS evidence_last_used ON evidence (last_used)')
+    self._db.commit()
+
+    self._max_entries = int(max_size_mb * 1e6 / _ENTRY_BYTES)
+    self._method = ('%s:%s' % (method, CACHE_VERSION)).encode('utf-8')
+    self.hits = 0
+    self.misses = 0
+
+  def hash_variants(self, variants):
+    return [common.hash_variant(V) for V in variants]
+
+  def _make_key(self, H1, H2):
+    return hashlib.sha1(self._method + H1 + H2).digest()
+
+  def _make_keys(self, pairs, hashes):
+    # Returns each pair's key, along with whether the pair is stored in swapped
+    # order.
+    keys = []
+    swapped = []
+    for A, B in pairs:
+      H1, H2 = hashes[A], hashes[B]
+      swapped.append(H1 > H2)
+      keys.append(self._make_key(*sorted((H1, H2))))
+    return (keys, np.array(swapped, dtype=bool))
+
+  def get(self, pairs, hashes):
+    '''Look up evidence for `pairs`, a list of (A, B) index pairs into
+    `hashes`. Returns an Nx5 array of evidence, with rows for missing pairs
+    set to NaN.'''
+    keys, swapped = self._make_keys(pairs, hashes)
+    found = {}
+    for start in range(0, len(keys), _QUERY_BATCH):
+      batch = keys[start:start + _QUERY_BATCH]
+      query = 'SELECT key, rels FROM evidence WHERE key IN (%s)' % ','.join('?' * len(batch))
+      for key, rels in self._db.execute(query, batch):
+        found[key] = np.frombuffer(rels, dtype=np.float64)
+
+    evidence = np.full((len(pairs), NUM_MODELS), np.nan)
+    for idx, key in enumerate(keys):
+      if key in found:
+        evidence[idx] = found[key][SWAP_A_B] if swapped[idx] else found[key]
+
+    hit_keys = list(found.keys())
+    now = time.time()
+    self._db.executemany('UPDATE evidence SET last_used = ? WHERE key = ?', [(now, K) for K in hit_keys])
+    self._db.commit()
+
+    num_hits = np.sum(~np.isnan(evidence[:,0]))
+    self.hits += num_hits
+    self.misses += len(pairs) - num_hits
+    return evidence
+
+  def put(self, pairs, hashes, evidence):
+    keys, swapped = self._make_keys(pairs, hashes)
+    now = time.time()
+    rows = []
+    for key, swap, E in zip(keys, swapped, evidence):
+      E = E[SWAP_A_B] if swap else E
+      rows.append((key, np.ascontiguousarray(E, dtype=np.float64).tobytes(), now))
+    self._db.executemany('INSERT OR REPLACE INTO evidence (key, rels, last_used) VALUES (?, ?, ?)', rows)
+    self._db.commit()
+    self._evict()
+
+  def _evict(self):
+    count = self._db.execute('SELECT COUNT(*) FROM evidence').fetchone()[0]
+    excess = count - self._max_entries
+    if excess <= 0:
+      return
+    self._db.execute('DELETE FROM evidence WHERE key IN (SELECT key FROM evidence ORDER BY last_used LIMIT ?)', (excess,))
+    self._db.commit()
+
+  def stats(self):
+    return {'hits': int(self.hits), 'misses': int(self.misses)}
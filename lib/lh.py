@@ -5,8 +5,10 @@ import scipy.integrate
 import numpy as np
 import util
 import warnings
+import collections
 import binom
 import lhmath_native
+import lhmath_numpy
 
 import os
 if os.environ.get('NUMBA_DISABLE_JIT', None) == '1':
@@ -132,22 +134,35 @@ def calc_lh_mc_2D_dumb(var1, var2):
 
   return logprob_models
 
-def _calc_garbage_smart(V1, V2):
-  S = len(V1.total_reads) # S
-  evidence = np.nan * np.ones(S)
-
-  for sidx in range(S):
-    logP = [-np.log(V1.omega_v[sidx]), -np.log(V2.omega_v[sidx])]
-    for V in (V1, V2):
-      A, B = V.var_reads[sidx] + 1, V.ref_reads[sidx] + 1
-      logP.append(util.log_N_choose_K(V.total_reads[sidx], V.var_reads[sidx]))
+def calc_garbage_terms(V):
+  '''The garbage evidence for a pair is a sum of terms that each depend on only
+  one of the two variants. Return these terms for variant `V` as an Sx4 array,
+  so they need be computed only once per variant rather than once per pair.
+  `V` can also be a `Variant` whose fields are MxS arrays, in which case an
+  MxSx4 array is returned.'''
+  A, B = V.var_reads + 1, V.ref_reads + 1
+  # Samples with `omega_v = 0` will produce infinite terms, but these are
+  # excluded by `_find_bad_samples` before the terms are used.
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return np.stack((
+      -np.log(V.omega_v),
+      util.log_N_choose_K(V.total_reads, V.var_reads),
       # `betainc` (the beta distribution CDF) can sometimes return exactly
       # zero, depending on the parameters.
-      logP.append(np.log(np.maximum(_EPSILON, scipy.special.betainc(A, B, V.omega_v[sidx]))))
-      logP.append(scipy.special.betaln(A, B)) # Denormalization factor for beta
-    evidence[sidx] = np.sum(logP)
+      np.log(np.maximum(_EPSILON, scipy.special.betainc(A, B, V.omega_v))),
+      scipy.special.betaln(A, B), # Denormalization factor for beta
+    ), axis=-1)
+
+def combine_garbage_terms(T1, T2):
+  '''Combine the per-variant terms from `calc_garbage_terms` into per-sample
+  garbage evidence, broadcasting over any leading dimensions.'''
+  # Sum in the same order as `np.sum` does over the list of eight terms that
+  # this function replaced, so that the evidence is bit-for-bit identical.
+  return ((T1[...,0] + T2[...,0]) + (T1[...,1] + T1[...,2])) + \
+         ((T1[...,3] + T2[...,1]) + (T2[...,2] + T2[...,3]))
 
-  return evidence
+def _calc_garbage_smart(V1, V2):
+  return combine_garbage_terms(calc_garbage_terms(V1), calc_garbage_terms(V2))
 
 def _calc_garbage_dumb(V1, V2):
   S = len(V1.total_reads) # S
@@ -207,13 +222,86 @@ def quad(*args, **kwargs):
     warnings.simplefilter('ignore', category=scipy.integrate.IntegrationWarning)
     return scipy.integrate.quad(*args, **kwargs)
 
-def calc_lh_quad(V1, V2, use_numba=True):
+class QuadMemo:
+  # The integrals computed by `calc_lh_quad` for a sample depend only on each
+  # variant's (var_reads, ref_reads, omega_v) in that sample. In low-depth or
+  # targeted sequencing, these triples repeat often across variants, so we
+  # remember the result for each pair of triples, evicting the least recently
+  # used once `max_entries` is reached.
+  #
+  # Each worker process gets its own copy of the memo, so the hit and miss
+  # counts are summed by the caller (see `pairwise._compute_pairs`).
+
+  def __init__(self, max_entries=100000):
+    assert max_entries > 0
+    self._max_entries = max_entries
+    self._memo = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def __getstate__(self):
+    # Don't ship entries to worker processes.
+    state = dict(self.__dict__)
+    state['_memo'] = collections.OrderedDict()
+    return state
+
+  def get(self, key):
+    val = self._memo.get(key)
+    if val is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+      self._memo.move_to_end(key)
+    return val
+
+  def put(self, key, val):
+    self._memo[key] = val
+    if len(self._memo) > self._max_entries:
+      self._memo.popitem(last=False)
+
+  def counts(self):
+    return (self.hits, self.misses)
+
+  def add_counts(self, hits, misses):
+    self.hits += hits
+    self.misses += misses
+
+  def stats(self):
+    total = self.hits + self.misses
+    return {
+      'hits': int(self.hits),
+      'misses': int(self.misses),
+      'hit_rate': self.hits / total if total > 0 else 0.,
+    }
+
+def _calc_logerr(P, P_error):
+  # Bound the error in log(max(_EPSILON, P)) implied by the integration error.
+  logP = np.log(np.maximum(_EPSILON, P))
+  return max(np.log(np.maximum(_EPSILON, P + P_error)) - logP, logP - np.log(np.maximum(_EPSILON, P - P_error)))
+
+def calc_lh_quad(V1, V2, use_numba=True, memo=None, limit=50, logerr=None):
+  '''If `logerr` is specified, it should be an SxM array, which will be filled
+  with a bound on the error in each log evidence value implied by the
+  integrator's error estimates. Integrals taken from `memo` are treated as
+  exact.'''
   if not NUMBA_AVAIL:
     use_numba = False
   S = len(V1.total_reads) # S
   logprob_models = np.nan * np.ones((S, NUM_MODELS)) # SxM
 
   for sidx in range(S):
+    if memo is not None:
+      key = (
+        int(V1.var_reads[sidx]), int(V1.ref_reads[sidx]), float(V1.omega_v[sidx]),
+        int(V2.var_reads[sidx]), int(V2.ref_reads[sidx]), float(V2.omega_v[sidx]),
+      )
+      memoized = memo.get(key)
+      if memoized is not None:
+        logprob_models[sidx] = memoized
+        if logerr is not None:
+          logerr[sidx] = 0
+        continue
+
     V1_phi_mle = V1.vaf[sidx] / V1.omega_v[sidx]
     V1_phi_mle = np.minimum(1, V1_phi_mle)
     V1_phi_mle = np.maximum(0, V1_phi_mle)
@@ -232,31 +320,64 @@ def calc_lh_quad(V1, V2, use_numba=True):
       if modelidx == Models.cocluster:
         if not use_numba:
           logmaxP = np.log(lhmath_native.integral_same_cluster(V1_phi_mle, V1, V2, sidx, 0) + _EPSILON)
-          P, P_error = quad(lhmath_native.integral_same_cluster, 0, 1, args=(V1, V2, sidx, logmaxP))
+          P, P_error = quad(lhmath_native.integral_same_cluster, 0, 1, args=(V1, V2, sidx, logmaxP), limit=limit)
         else:
           logmax_args = np.array((V1_phi_mle, *args, 0)).astype(np.float64)
           logmaxP = np.log(lhmath_numba._integral_same_cluster(logmax_args) + _EPSILON)
-          P, P_error = quad(lhmath_numba.integral_same_cluster, 0, 1, args + (logmaxP,))
+          P, P_error = quad(lhmath_numba.integral_same_cluster, 0, 1, args + (logmaxP,), limit=limit)
 
+        if logerr is not None:
+          logerr[sidx,modelidx] = _calc_logerr(P, P_error)
         P = np.maximum(_EPSILON, P)
         logP = np.log(P) + logmaxP
 
       else:
         if not use_numba:
           logmaxP = np.log(lhmath_native.integral_separate_clusters(V1_phi_mle, V1, V2, sidx, modelidx, 0) + _EPSILON)
-          P, P_error = quad(lhmath_native.integral_separate_clusters, 0, 1, args=(V1, V2, sidx, modelidx, logmaxP))
+          P, P_error = quad(lhmath_native.integral_separate_clusters, 0, 1, args=(V1, V2, sidx, modelidx, logmaxP), limit=limit)
         else:
           logmax_args = np.array((V1_phi_mle, *args, modelidx, 0)).astype(np.float64)
           logmaxP = np.log(lhmath_numba._integral_separate_clusters(logmax_args) + _EPSILON)
-          P, P_error = quad(lhmath_numba.integral_separate_clusters, 0, 1, args + (modelidx, logmaxP))
+          P, P_error = quad(lhmath_numba.integral_separate_clusters, 0, 1, args + (modelidx, logmaxP), limit=limit)
 
         logdenorm = scipy.special.betaln(V2.var_reads[sidx] + 1, V2.ref_reads[sidx] + 1)
+        if logerr is not None:
+          logerr[sidx,modelidx] = _calc_logerr(P, P_error)
         P = np.maximum(_EPSILON, P)
         logP = np.log(P) + logmaxP + logdenorm + np.log(2) + util.log_N_choose_K(V2.total_reads[sidx], V2.var_reads[sidx]) - np.log(V2.omega_v[sidx])
 
       logprob_models[sidx,modelidx] = logP
+    if memo is not None:
+      memo.put(key, logprob_models[sidx].copy())
   return logprob_models
 
+def calc_lh_numba(V1, V2, limit=50, logerr=None):
+  # Integrate all samples and models for the pair in a single compiled call,
+  # using the same tolerances as `quad`. `logerr` behaves as in
+  # `calc_lh_quad`.
+  if not NUMBA_AVAIL:
+    raise Exception('calc_lh_numba requires Numba, but NUMBA_DISABLE_JIT is set')
+  logprob_models, pair_logerr = lhmath_numba.calc_lh_pair(
+    V1.var_reads,
+    V1.ref_reads,
+    V1.omega_v,
+    V2.var_reads,
+    V2.ref_reads,
+    V2.omega_v,
+    1.49e-8,
+    1.49e-8,
+    limit,
+  )
+  if logerr is not None:
+    logerr[:] = pair_logerr
+  return logprob_models
+
+def calc_lh_numpy(V1, V2):
+  # Integrate all samples and models for the pair at once with vectorized
+  # NumPy, which needs no compilation. Without Numba, this is far faster than
+  # `calc_lh_quad`.
+  return lhmath_numpy.calc_lh_pair(V1, V2)
+
 def _find_bad_samples(V1, V2):
   read_threshold = 3
   omega_threshold = 1e-3
@@ -335,7 +456,10 @@ def _compare_algorithms(V1, V2, S, good_samples):
   print(np.array(all_evidence), flush=True)
   print()
 
-def calc_lh(V1, V2, _calc_lh=None):
+def calc_lh(V1, V2, _calc_lh=None, garbage=None):
+  '''If `garbage` is specified, it should be the per-sample garbage evidence
+  for the pair across all samples, as computed by `combine_garbage_terms`.
+  Otherwise, it will be computed here.'''
   if _calc_lh is None:
     _calc_lh = calc_lh_quad
 
@@ -357,7 +481,10 @@ def calc_lh(V1, V2, _calc_lh=None):
   #_compare_algorithms(V1, V2, S, good_samples)
 
   evidence_per_sample[good_samples] = _calc_lh(V1, V2)
-  evidence_per_sample[good_samples,Models.garbage] = calc_garbage(V1, V2)
+  if garbage is None:
+    evidence_per_sample[good_samples,Models.garbage] = calc_garbage(V1, V2)
+  else:
+    evidence_per_sample[good_samples,Models.garbage] = garbage[good_samples]
   evidence = np.sum(evidence_per_sample, axis=0)
 
   return (evidence, evidence_per_sample)
@@ -0,0 +1,177 @@
+import numpy as np
+import scipy.stats
+import scipy.special
+
+from common import Models, NUM_MODELS, _EPSILON
+import util
+import lh
+import mutrel
+
+# Rather than integrating each pair of variants separately (as `lh.calc_lh_quad`
+# does), evaluate every variant's binomial likelihood once on a fixed grid of
+# phi values for each sample. Each of the pairwise integrals is then a sum over
+# the grid of (likelihood of variant 1) * (something depending only on variant
+# 2), which for all pairs at once is just a matrix product.
+#
+# For the A_B, B_A, and diff_branches models, the inner integral over variant
+# 2's phi is the prefix integral of its binomial likelihood, which we evaluate
+# in closed form via the beta CDF, exactly as `lhmath_numba` does. Only the
+# outer integral is approximated on the grid, using the trapezoid rule.
+
+def _make_grid(grid_points):
+  assert grid_points >= 3
+  phi = np.linspace(0, 1, grid_points)
+  weights = np.full(grid_points, 1 / (grid_points - 1))
+  weights[0] /= 2
+  weights[-1] /= 2
+  return (phi, weights)
+
+def _extract_mats(variants):
+  V = np.array([var.var_reads for var in variants])
+  R = np.array([var.ref_reads for var in variants])
+  omega = np.array([var.omega_v for var in variants])
+  return (V, R, V + R, omega)
+
+def _find_bad_pairs(V, omega):
+  # This is a vectorized version of `lh._find_bad_samples`, returning an MxM
+  # mask for a single sample.
+  read_threshold = 3
+  omega_threshold = 1e-3
+  too_few = V < read_threshold
+  uninformative = omega < omega_threshold
+  return np.logical_and(
+    np.logical_and(too_few[:,None], too_few[None,:]),
+    np.logical_or(uninformative[:,None], uninformative[None,:]),
+  )
+
+def _calc_sample_terms(V, R, N, omega, phi, weights):
+  # All returned arrays are MxG, except for the normalizers, which are
+  # length-M.
+  A, B = V + 1, R + 1
+  log_binom = scipy.stats.binom.logpmf(V[:,None], N[:,None], omega[:,None]*phi[None,:])
+  log_binom_max = np.max(log_binom, axis=1)
+  binom = np.exp(log_binom - log_binom_max[:,None])
+  # Lower limits for B_A are the upper limits for A_B, so `cdf` serves as both.
+  # `cdf_total - cdf` is the integral from phi to 1.
+  cdf = scipy.special.betainc(A[:,None], B[:,None], omega[:,None]*phi[None,:])
+  cdf_total = scipy.special.betainc(A, B, omega)
+  log_cdf_norm = scipy.special.betaln(A, B) + np.log(2) + util.log_N_choose_K(N, V) - np.log(omega)
+
+  return {
+    'weighted_binom': binom * weights[None,:],
+    'binom': binom,
+    'log_binom_max': log_binom_max,
+    'cdf': cdf,
+    'ccdf': np.maximum(0, cdf_total[:,None] - cdf),
+    # The grid is symmetric about 0.5, so reversing it gives us the beta CDF
+    # evaluated at 1 - phi.
+    'cdf_rev': cdf[:,::-1],
+    'log_cdf_norm': log_cdf_norm,
+  }
+
+def _log_dot(X, Y):
+  return np.log(np.maximum(_EPSILON, np.dot(X, Y.T)))
+
+def _calc_block(T, rows, cols):
+  # Compute evidence for variants in `rows` (acting as variant 1) against
+  # variants in `cols` (acting as variant 2) for a single sample.
+  WB = T['weighted_binom'][rows]
+  block = np.zeros((len(rows), len(cols), NUM_MODELS))
+
+  block[:,:,Models.cocluster] = _log_dot(WB, T['binom'][cols]) + \
+    T['log_binom_max'][rows][:,None] + \
+    T['log_binom_max'][cols][None,:]
+  for midx, key in ((Models.A_B, 'cdf'), (Models.B_A, 'ccdf'), (Models.diff_branches, 'cdf_rev')):
+    block[:,:,midx] = _log_dot(WB, T[key][cols]) + \
+      T['log_binom_max'][rows][:,None] + \
+      T['log_cdf_norm'][cols][None,:]
+  return block
+
+def calc_evidence(variants, grid_points=2001, block_size=512, pbar=None, per_sample=False, packed=False, dtype=np.float64):
+  '''Compute the MxMx5 pairwise evidence tensor for all pairs of `variants`,
+  which should be a list of `common.Variant` namedtuples. If `per_sample` is
+  set, return the MxMxSx5 tensor of evidence for each sample instead. If
+  `packed` is set, return a `mutrel.PackedRels` with the given `dtype`.'''
+  M = len(variants)
+  V, R, N, omega = _extract_mats(variants)
+  S = V.shape[1]
+  phi, weights = _make_grid(grid_points)
+  # Garbage evidence for a pair is a sum of terms that each depend on only one
+  # of the variants, so we compute the terms once for each variant.
+  garbage_terms = np.array([lh.calc_garbage_terms(var) for var in variants])
+  if per_sample:
+    evidence = np.zeros((M, M, S, NUM_MODELS))
+  elif packed:
+    # Accumulate at full precision, converting to `dtype` only at the end.
+    evidence = mutrel.PackedRels(np.zeros((M*(M + 1) // 2, NUM_MODELS)))
+  else:
+    evidence = np.zeros((M, M, NUM_MODELS))
+
+  with np.errstate(divide='ignore', invalid='ignore', under='ignore'):
+    for sidx in range(S):
+      T = _calc_sample_terms(V[:,sidx], R[:,sidx], N[:,sidx], omega[:,sidx], phi, weights)
+      garbage = garbage_terms[:,sidx]
+      bad_pairs = _find_bad_pairs(V[:,sidx], omega[:,sidx])
+
+      # Compute only the upper triangle, which we later mirror to the lower
+      # triangle, in the same manner as `pairwise._compute_pairs`.
+      for start in range(0, M, block_size):
+        rows = np.arange(start, min(M, start + block_size))
+        cols = np.arange(start, M)
+        block = _calc_block(T, rows, cols)
+        block[:,:,Models.garbage] = lh.combine_garbage_terms(garbage[rows][:,None], garbage[cols][None,:])
+        block[bad_pairs[np.ix_(rows, cols)]] = 0
+        if per_sample:
+          evidence[start:rows[-1]+1,start:,sidx] = block
+        elif packed:
+          for ridx, row in enumerate(rows):
+            evidence.data[evidence._row_slice(row)] += block[ridx,ridx:]
+        else:
+          evidence[start:rows[-1]+1,start:] += block
+        if pbar is not None:
+          pbar.update()
+
+  if packed:
+    # Packed storage needs no mirroring. Pairs consisting of the same variant
+    # twice fall at the start of each packed row.
+    diag = [evidence._row_slice(idx).start for idx in range(M)]
+    evidence.data[diag] = -np.inf
+    evidence.data[diag,Models.cocluster] = 0
+    return mutrel.PackedRels(evidence.data.astype(dtype))
+
+  I, J = np.tril_indices(M, -1)
+  evidence[I,J] = evidence[J,I]
+  evidence[I,J,...,Models.A_B], evidence[I,J,...,Models.B_A] = evidence[I,J,...,Models.B_A], evidence[I,J,...,Models.A_B]
+
+  # If they're the same variant, they should cocluster with certainty.
+  diag = range(M)
+  evidence[diag,diag] = -np.inf
+  evidence[diag,diag,...,Models.cocluster] = 0
+  return evidence
+
+def count_blocks(M, S, block_size=512):
+  return S * int(np.ceil(M / block_size))
+
+def check_against_quad(variants, posterior, logprior, tol, num_pairs=100):
+  '''Compare the posterior computed on the grid for a random subset of pairs
+  against that computed by `lh.calc_lh_quad`, raising an exception if any
+  relation probability differs by more than `tol`.'''
+  import pairwise
+
+  M = len(variants)
+  pairs = np.array(np.triu_indices(M, 1)).T
+  if len(pairs) == 0:
+    return 0.
+  # Use a private PRNG so the check doesn't perturb the global random state
+  # used by the tree sampler.
+  rng = np.random.default_rng(seed=M)
+  pairs = rng.permutation(pairs)[:num_pairs]
+
+  max_diff = 0.
+  for A, B in pairs:
+    evidence, _ = lh.calc_lh(variants[A], variants[B])
+    post = pairwise._calc_posterior(evidence, logprior)
+    max_diff = max(max_diff, np.max(np.abs(post - posterior[A,B])))
+  if max_diff > tol:
+    raise Exception('Grid posterior differs from quad posterior by %s, exceeding tolerance %s. Try increasing the number of grid points.' % (max_diff, tol))
+  return max_diff
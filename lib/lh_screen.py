@@ -0,0 +1,148 @@
+import numpy as np
+import scipy.special
+import scipy.stats
+
+from common import Models, NUM_MODELS
+import lh
+
+# For many pairs, the read counts alone settle the relationship: in every
+# sample, one variant's phi is certainly above the other's, and their phis
+# certainly sum to more (or less) than one. Integrating such pairs with
+# `lh.calc_lh_quad` spends full cost confirming what we already know. Instead,
+# we screen pairs using credible intervals on each variant's phi, and estimate
+# evidence for the decisive ones in closed form.
+#
+# Under a uniform prior on phi, the posterior of variant i's phi in a sample
+# is the Beta(V_i + 1, R_i + 1) distribution truncated to [0, omega_i], scaled
+# by 1/omega_i. Its normalizer m_i is exactly what the garbage model computes,
+# with garbage evidence being log(m_1 * m_2). The evidence for the A_B, B_A,
+# and diff_branches models is then
+#
+#   log(2) + log(m_1 * m_2) + log(P(phi_1, phi_2 fall in the model's region))
+#
+# where the probability is taken under the two independent phi posteriors.
+# Let [lo_i, hi_i] be the central credible interval for phi_i with total tail
+# mass `alpha`. If lo_1 > hi_2, the pair can only fall outside the A_B region
+# if one of the two phis falls outside its interval, so P(A_B) >= 1 - alpha and
+# P(B_A) <= alpha. The same argument applies to diff_branches, using lo_1 +
+# lo_2 > 1 or hi_1 + hi_2 < 1. When the intervals are disjoint, the cocluster
+# evidence is log(m_1 * m_2 * integral(p_1 * p_2)), where the integral is at
+# most alpha * (max(p_1) + max(p_2)), since every phi lies outside at least one
+# interval.
+#
+# A sample is decisive if every model is resolved in this way. For a decisive
+# sample, we set the probability of each consistent model to one, and that of
+# each excluded model to a normal approximation clamped to the bound above.
+# This yields the following error bounds per sample:
+#
+#   * For a consistent model, the log evidence is overestimated by at most
+#     -log(1 - alpha).
+#   * For an excluded model, both the exact and estimated evidence are at most
+#     log(2 * alpha) + log(m_1 * m_2) for A_B, B_A, and diff_branches, and
+#     log(alpha * (max(p_1) + max(p_2))) + log(m_1 * m_2) for cocluster.
+#
+# A pair takes the fast path only if all its samples are decisive (or are
+# samples that `lh._find_bad_samples` would exclude), and if these samples
+# agree on both which variant's phi is larger and whether the phis sum to more
+# than one. Otherwise, a model consistent in one sample could be excluded in
+# another, leaving no model whose evidence is accurate. For instance, if A_B
+# holds in one sample and B_A in another, every tree model's evidence comes
+# from the normal approximations, for which the bounds above say nothing about
+# the relative evidence of the models. Garbage evidence is always exact.
+
+def _calc_phi_bounds(variants, alpha):
+  # Returns the credible interval bounds and log of the maximum density of
+  # each variant's phi posterior, as MxS arrays.
+  V = np.array([var.var_reads for var in variants])
+  R = np.array([var.ref_reads for var in variants])
+  omega = np.array([var.omega_v for var in variants])
+  A, B = V + 1, R + 1
+
+  # Samples with `omega = 0` produce NaN bounds, which are never decisive.
+  with np.errstate(divide='ignore', invalid='ignore'):
+    total = scipy.special.betainc(A, B, omega)
+    lo = scipy.special.betaincinv(A, B, (alpha/2)*total) / omega
+    hi = scipy.special.betaincinv(A, B, (1 - alpha/2)*total) / omega
+    # The beta mode is V/(V+R). When V+R = 0, the density is uniform, so any
+    # point will do.
+    mode = np.minimum(omega, np.where(V + R > 0, V / np.maximum(1, V + R), 0))
+    logmax = np.log(omega) + scipy.stats.beta.logpdf(mode, A, B) - np.log(total)
+  return (lo, hi, logmax, V, omega)
+
+def _agree_across_samples(M1, M2, bad):
+  # For PxS arrays `M1` and `M2` of mutually exclusive decisions, return
+  # whether each pair makes the same decision in all samples that aren't bad.
+  return np.logical_or(
+    np.all(np.logical_or(bad, M1), axis=1),
+    np.all(np.logical_or(bad, M2), axis=1),
+  )
+
+class DecisiveScreen:
+  def __init__(self, alpha=1e-6):
+    assert 0 < alpha < 1
+    self._alpha = alpha
+    self.screened = 0
+    self.fast = 0
+
+  def screen(self, pairs, variants, garbage_terms):
+    '''Classify (A, B) index pairs into `variants` as decisive or uncertain.
+    Returns a boolean mask of decisive pairs, along with their summed and
+    per-sample evidence. `garbage_terms` should be the MxSx4 array of terms
+    from `lh.calc_garbage_terms`.'''
+    pairs = np.array(pairs, dtype=int).reshape(-1, 2)
+    lo, hi, logmax, V, omega = _calc_phi_bounds(variants, self._alpha)
+    I, J = pairs[:,0], pairs[:,1]
+
+    # This is a vectorized version of `lh._find_bad_samples`.
+    bad = np.logical_and(
+      np.logical_and(V[I] < 3, V[J] < 3),
+      np.logical_or(omega[I] < 1e-3, omega[J] < 1e-3),
+    )
+    A_B = lo[I] > hi[J]
+    B_A = hi[I] < lo[J]
+    diff_branches = hi[I] + hi[J] < 1
+    not_diff_branches = lo[I] + lo[J] > 1
+    decisive_samples = np.logical_or(bad, np.logical_and(
+      np.logical_or(A_B, B_A),
+      np.logical_or(diff_branches, not_diff_branches),
+    ))
+    decisive = np.logical_and.reduce((
+      np.all(decisive_samples, axis=1),
+      _agree_across_samples(A_B, B_A, bad),
+      _agree_across_samples(diff_branches, not_diff_branches, bad),
+    ))
+    self.screened += len(pairs)
+    self.fast += np.sum(decisive)
+
+    I, J = I[decisive], J[decisive]
+    A_B, B_A, diff_branches, bad = A_B[decisive], B_A[decisive], diff_branches[decisive], bad[decisive]
+    garbage = lh.combine_garbage_terms(garbage_terms[I], garbage_terms[J])
+
+    # Normal approximations for excluded models, with means and standard
+    # deviations derived from the credible intervals.
+    z = scipy.special.ndtri(1 - self._alpha/2)
+    mu1, mu2 = (lo[I] + hi[I]) / 2, (lo[J] + hi[J]) / 2
+    scale = np.sqrt(((hi[I] - lo[I])/(2*z))**2 + ((hi[J] - lo[J])/(2*z))**2)
+    scale = np.maximum(scale, 1e-12)
+    logalpha = np.log(self._alpha)
+
+    evidence_per_sample = np.zeros((len(I), V.shape[1], NUM_MODELS))
+    with np.errstate(divide='ignore', invalid='ignore'):
+      evidence_per_sample[:,:,Models.garbage] = garbage
+      evidence_per_sample[:,:,Models.cocluster] = garbage + np.minimum(
+        logalpha + np.logaddexp(logmax[I], logmax[J]),
+        scipy.stats.norm.logpdf(mu1 - mu2, scale=scale),
+      )
+      for midx, consistent, logprob in (
+        (Models.A_B,           A_B,           scipy.special.log_ndtr((mu1 - mu2) / scale)),
+        (Models.B_A,           B_A,           scipy.special.log_ndtr((mu2 - mu1) / scale)),
+        (Models.diff_branches, diff_branches, scipy.special.log_ndtr((1 - mu1 - mu2) / scale)),
+      ):
+        evidence_per_sample[:,:,midx] = garbage + np.log(2) + np.where(consistent, 0, np.minimum(logalpha, logprob))
+    evidence_per_sample[bad] = 0
+
+    evidence = np.sum(evidence_per_sample, axis=1)
+    return (decisive, evidence, evidence_per_sample)
+
+  def stats(self):
+    return {'screened': int(self.screened), 'fast_path': int(self.fast), 'alpha': self._alpha}
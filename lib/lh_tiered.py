@@ -0,0 +1,104 @@
+import numpy as np
+import scipy.special
+
+from common import Models, NUM_MODELS
+import lh
+
+# Adaptive integration with `limit=50` subintervals spends most of its effort
+# on pairs whose posterior would be just as decisive with far less precision.
+# Instead, integrate every pair first with a fixed budget of only a few
+# Gauss-Kronrod subintervals (`limit=4`), which also yields an error estimate
+# for each integral. (A single rule over all of [0, 1] is cheaper still, but
+# resolves the narrow peaks of deeply sequenced variants so poorly that its
+# error estimates let almost no pairs through.) From these, we bound each
+# model's log evidence within [E - d, E + d], and so bound each relation's
+# posterior probability. Only if a probability could be off by more than
+# `tol`, or a different relation could have the highest posterior, do we
+# escalate to full adaptive integration.
+#
+# The tier used for each pair is recorded in `tiers`, an MxM matrix.
+
+TIER_NONE = 0
+TIER_FIXED = 1
+TIER_ADAPTIVE = 2
+
+def _calc_posterior_bounds(evidence, logerr, logprior):
+  # Bound the posterior of each model, given that each model's log evidence
+  # may be off by as much as `logerr`. Models excluded by the prior are
+  # excluded from the bounds.
+  active = np.isfinite(logprior)
+  joint = (evidence + logprior)[active]
+  logerr = logerr[active]
+  upper, lower = joint + logerr, joint - logerr
+
+  post_upper = np.zeros(NUM_MODELS)
+  post_lower = np.zeros(NUM_MODELS)
+  for idx, midx in enumerate(np.flatnonzero(active)):
+    others = np.arange(len(joint)) != idx
+    # A model's probability is highest when its own evidence is at its upper
+    # bound and every other model's is at its lower bound, and vice versa.
+    post_upper[midx] = np.exp(upper[idx] - np.logaddexp(upper[idx], scipy.special.logsumexp(lower[others])))
+    post_lower[midx] = np.exp(lower[idx] - np.logaddexp(lower[idx], scipy.special.logsumexp(upper[others])))
+
+  # The highest-posterior model can change only if its lower bound doesn't
+  # clear every other model's upper bound.
+  best = np.argmax(joint)
+  others = np.arange(len(joint)) != best
+  argmax_stable = len(joint) == 1 or lower[best] > np.max(upper[others])
+  return (post_lower, post_upper, argmax_stable)
+
+class TieredIntegration:
+  def __init__(self, tol=1e-3, fixed_limit=4):
+    assert 0 < tol < 1
+    self._tol = tol
+    self._fixed_limit = fixed_limit
+    self.tiers = None
+    self.counts = np.zeros(TIER_ADAPTIVE + 1, dtype=int)
+
+  def __getstate__(self):
+    # Workers need only the settings, not the tiers recorded so far.
+    state = self.__dict__.copy()
+    state['tiers'] = None
+    return state
+
+  def init_tiers(self, M):
+    self.tiers = np.full((M, M), TIER_NONE, dtype=np.int8)
+
+  def record(self, block, block_tiers):
+    A, B = block[:,0], block[:,1]
+    self.tiers[A,B] = self.tiers[B,A] = block_tiers
+    self.counts += np.bincount(block_tiers, minlength=len(self.counts))
+
+  def calc_lh(self, V1, V2, logprior, calc_lh_fixed, calc_lh_full, garbage=None):
+    '''Compute evidence for the pair as `lh.calc_lh` does, returning the tier
+    used along with the summed and per-sample evidence. `calc_lh_fixed` must
+    accept the `limit` and `logerr` arguments of `lh.calc_lh_quad`, while
+    `calc_lh_full` is used to escalate.'''
+    if V1.id == V2.id:
+      return (*lh.calc_lh(V1, V2, calc_lh_full, garbage), TIER_NONE)
+
+    # `lh.calc_lh` passes only the samples it doesn't discard to its `_calc_lh`
+    # function, so collect the error bounds for those samples here.
+    sample_logerr = []
+    def _calc_fixed(V1, V2):
+      logerr = np.zeros((len(V1.omega_v), NUM_MODELS))
+      sample_logerr.append(logerr)
+      return calc_lh_fixed(V1, V2, limit=self._fixed_limit, logerr=logerr)
+
+    evidence, evidence_per_sample = lh.calc_lh(V1, V2, _calc_fixed, garbage)
+    # Garbage evidence is exact.
+    logerr = np.sum(sample_logerr[0], axis=0)
+    logerr[Models.garbage] = 0
+
+    post_lower, post_upper, argmax_stable = _calc_posterior_bounds(evidence, logerr, logprior)
+    if argmax_stable and np.max(post_upper - post_lower) <= self._tol:
+      return (evidence, evidence_per_sample, TIER_FIXED)
+    evidence, evidence_per_sample = lh.calc_lh(V1, V2, calc_lh_full, garbage)
+    return (evidence, evidence_per_sample, TIER_ADAPTIVE)
+
+  def stats(self):
+    return {
+      'fixed': int(self.counts[TIER_FIXED]),
+      'adaptive': int(self.counts[TIER_ADAPTIVE]),
+      'tol': self._tol,
+    }
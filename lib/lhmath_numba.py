@@ -100,3 +100,212 @@ def _make_jitted_integrand(integrand):
 
 integral_separate_clusters = _make_jitted_integrand(_integral_separate_clusters)
 integral_same_cluster      = _make_jitted_integrand(_integral_same_cluster)
+
+# Rather than calling `scipy.integrate.quad` once for each sample and model
+# (as `lh.calc_lh_quad` does), `calc_lh_pair` below computes all samples and
+# models for a pair in a single compiled call, using its own adaptive
+# Gauss-Kronrod integrator. This follows QUADPACK's QAGS routine (which `quad`
+# uses for finite intervals) with its 21-point rule, but without the
+# epsilon-algorithm extrapolation QAGS adds for endpoint singularities, which
+# our integrands don't have.
+
+# Nodes and weights for the 21-point Kronrod rule and the embedded 10-point
+# Gauss rule, from QUADPACK's QK21. Gauss nodes are the odd-indexed Kronrod
+# nodes, with the final node being the centre, which the Gauss rule lacks.
+_XGK = np.array((
+  0.995657163025808080735527280689003,
+  0.973906528517171720077964012084452,
+  0.930157491355708226001207180059508,
+  0.865063366688984510732096688423493,
+  0.780817726586416897063717578345042,
+  0.679409568299024406234327365114874,
+  0.562757134668604683339000099272694,
+  0.433395394129247190799265943165784,
+  0.294392862701460198131126603103866,
+  0.148874338981631210884826001129720,
+  0.000000000000000000000000000000000,
+))
+_WGK = np.array((
+  0.011694638867371874278064396062192,
+  0.032558162307964727478818972459390,
+  0.054755896574351996031381300244580,
+  0.075039674810919952767043140916190,
+  0.093125454583697605535065465083366,
+  0.109387158802297641899210590325805,
+  0.123491976262065851077208034522567,
+  0.134709217311473325928054001771707,
+  0.142775938577060080797094273138717,
+  0.147739104901338491374841515972068,
+  0.149445554002916905664936468389821,
+))
+_WG = np.array((
+  0.066671344308688137593568809893332,
+  0.149451349150580593145776339657697,
+  0.219086362515982043995534934228163,
+  0.269266719309996355091226921569469,
+  0.295524224714752870173892994651338,
+))
+_EPMACH = np.finfo(np.float64).eps
+_UFLOW = np.finfo(np.float64).tiny
+
+# Layout of the argument array used by the kernel's integrands.
+_ARG_PHI1, _ARG_V1_VAR, _ARG_V1_REF, _ARG_V1_OMEGA, _ARG_V1_LOGNCK, _ARG_V2_VAR, _ARG_V2_REF, _ARG_V2_OMEGA, _ARG_V2_LOGNCK, _ARG_MIDX, _ARG_LOGSUB = range(11)
+_NUM_ARGS = 11
+
+@numba.njit
+def _binom_logpmf_scalar(X, N, P, logNCK):
+  # This matches `binom.logpmf`, but works on scalars without allocating
+  # arrays, and takes the binomial coefficient precomputed.
+  if util.isclose(0, P):
+    return 0. if X == 0 else -np.inf
+  if util.isclose(1, P):
+    return 0. if X == N else -np.inf
+  return logNCK + X*np.log(P) + (N - X)*np.log(1 - P)
+
+@numba.njit
+def _integrand(phi1, args, same_cluster):
+  V1_var_reads, V1_ref_reads = args[_ARG_V1_VAR], args[_ARG_V1_REF]
+  V2_var_reads, V2_ref_reads = args[_ARG_V2_VAR], args[_ARG_V2_REF]
+  logP = _binom_logpmf_scalar(V1_var_reads, V1_var_reads + V1_ref_reads, args[_ARG_V1_OMEGA] * phi1, args[_ARG_V1_LOGNCK])
+
+  if same_cluster:
+    logP += _binom_logpmf_scalar(V2_var_reads, V2_var_reads + V2_ref_reads, args[_ARG_V2_OMEGA] * phi1, args[_ARG_V2_LOGNCK])
+  else:
+    midx = args[_ARG_MIDX]
+    A = V2_var_reads + 1
+    B = V2_ref_reads + 1
+    betainc_upper = betacdf(A, B, args[_ARG_V2_OMEGA] * _make_upper(phi1, midx))
+    betainc_lower = betacdf(A, B, args[_ARG_V2_OMEGA] * _make_lower(phi1, midx))
+    if util.isclose(betainc_upper, betainc_lower):
+      return 0.
+    logP += np.log(betainc_upper - betainc_lower)
+
+  return np.exp(logP - args[_ARG_LOGSUB])
+
+@numba.njit
+def _qk21(args, same_cluster, A, B):
+  centr = 0.5*(A + B)
+  hlgth = 0.5*(B - A)
+  dhlgth = np.abs(hlgth)
+
+  fv1 = np.zeros(10)
+  fv2 = np.zeros(10)
+  fc = _integrand(centr, args, same_cluster)
+  resg = 0.
+  resk = fc * _WGK[10]
+  resabs = np.abs(resk)
+  for j in range(10):
+    absc = hlgth * _XGK[j]
+    fval1 = _integrand(centr - absc, args, same_cluster)
+    fval2 = _integrand(centr + absc, args, same_cluster)
+    fv1[j] = fval1
+    fv2[j] = fval2
+    fsum = fval1 + fval2
+    resk += _WGK[j] * fsum
+    resabs += _WGK[j] * (np.abs(fval1) + np.abs(fval2))
+    if j % 2 == 1:
+      resg += _WG[j // 2] * fsum
+
+  reskh = 0.5 * resk
+  resasc = _WGK[10] * np.abs(fc - reskh)
+  for j in range(10):
+    resasc += _WGK[j] * (np.abs(fv1[j] - reskh) + np.abs(fv2[j] - reskh))
+
+  result = resk * hlgth
+  resabs *= dhlgth
+  resasc *= dhlgth
+  abserr = np.abs((resk - resg) * hlgth)
+  if resasc != 0 and abserr != 0:
+    abserr = resasc * min(1., (200 * abserr / resasc)**1.5)
+  if resabs > _UFLOW / (50 * _EPMACH):
+    abserr = max(_EPMACH * 50 * resabs, abserr)
+  return (result, abserr, resasc)
+
+@numba.njit
+def _integrate(args, same_cluster, epsabs, epsrel, limit):
+  # Integrate over [0, 1], repeatedly bisecting the subinterval with the
+  # largest error estimate until the total error is small enough.
+  lower = np.zeros(limit)
+  upper = np.zeros(limit)
+  results = np.zeros(limit)
+  errors = np.zeros(limit)
+  upper[0] = 1.
+  results[0], errors[0], resasc = _qk21(args, same_cluster, 0., 1.)
+  N = 1
+  # As in QAGS, don't trust the first estimate if its error is just the
+  # rule's crude bound, which happens when the Gauss and Kronrod results
+  # disagree badly (e.g., because both missed a narrow peak).
+  if errors[0] == resasc and errors[0] != 0:
+    first_reliable = False
+  else:
+    first_reliable = True
+
+  while N < limit:
+    total = np.sum(results[:N])
+    if np.sum(errors[:N]) <= max(epsabs, epsrel * np.abs(total)) and (N > 1 or first_reliable):
+      break
+    worst = np.argmax(errors[:N])
+    A, B = lower[worst], upper[worst]
+    mid = 0.5*(A + B)
+    results[worst], errors[worst], _ = _qk21(args, same_cluster, A, mid)
+    upper[worst] = mid
+    lower[N], upper[N] = mid, B
+    results[N], errors[N], _ = _qk21(args, same_cluster, mid, B)
+    N += 1
+  return (np.sum(results[:N]), np.sum(errors[:N]))
+
+@numba.njit
+def _calc_logerr(P, P_error, eps):
+  # Bound the error in log(max(eps, P)) implied by the integration error.
+  logP = np.log(max(eps, P))
+  return max(np.log(max(eps, P + P_error)) - logP, logP - np.log(max(eps, P - P_error)))
+
+@numba.njit(error_model='numpy')
+def calc_lh_pair(V1_var_reads, V1_ref_reads, V1_omega, V2_var_reads, V2_ref_reads, V2_omega, epsabs, epsrel, limit):
+  # Along with the log evidence, return a bound on its error for each sample
+  # and model, as implied by the integrator's error estimates.
+  S = len(V1_var_reads)
+  logprob_models = np.full((S, len(Models)), np.nan)
+  logerr = np.full((S, len(Models)), np.nan)
+  args = np.zeros(_NUM_ARGS)
+  eps = np.exp(-30.)
+
+  for sidx in range(S):
+    V1_total_reads = V1_var_reads[sidx] + V1_ref_reads[sidx]
+    V2_total_reads = V2_var_reads[sidx] + V2_ref_reads[sidx]
+    # As in `inputparser`, samples with no reads have a VAF of zero.
+    V1_vaf = V1_var_reads[sidx] / V1_total_reads if V1_total_reads > 0 else 0.
+    V1_phi_mle = V1_vaf / V1_omega[sidx]
+    if not np.isnan(V1_phi_mle):
+      V1_phi_mle = min(1., max(0., V1_phi_mle))
+
+    args[_ARG_V1_VAR] = V1_var_reads[sidx]
+    args[_ARG_V1_REF] = V1_ref_reads[sidx]
+    args[_ARG_V1_OMEGA] = V1_omega[sidx]
+    args[_ARG_V1_LOGNCK] = util.log_N_choose_K(V1_total_reads, V1_var_reads[sidx])
+    args[_ARG_V2_VAR] = V2_var_reads[sidx]
+    args[_ARG_V2_REF] = V2_ref_reads[sidx]
+    args[_ARG_V2_OMEGA] = V2_omega[sidx]
+    args[_ARG_V2_LOGNCK] = util.log_N_choose_K(V2_total_reads, V2_var_reads[sidx])
+
+    args[_ARG_LOGSUB] = 0.
+    logmaxP = np.log(_integrand(V1_phi_mle, args, True) + eps)
+    args[_ARG_LOGSUB] = logmaxP
+    P, P_error = _integrate(args, True, epsabs, epsrel, limit)
+    logerr[sidx,Models.cocluster] = _calc_logerr(P, P_error, eps)
+    P = max(eps, P)
+    logprob_models[sidx,Models.cocluster] = np.log(P) + logmaxP
+
+    logdenorm = util.lbeta(V2_var_reads[sidx] + 1, V2_ref_reads[sidx] + 1)
+    lognorm = logdenorm + np.log(2) + args[_ARG_V2_LOGNCK] - np.log(V2_omega[sidx])
+    for modelidx in (Models.A_B, Models.B_A, Models.diff_branches):
+      args[_ARG_MIDX] = modelidx
+      args[_ARG_LOGSUB] = 0.
+      logmaxP = np.log(_integrand(V1_phi_mle, args, False) + eps)
+      args[_ARG_LOGSUB] = logmaxP
+      P, P_error = _integrate(args, False, epsabs, epsrel, limit)
+      logerr[sidx,modelidx] = _calc_logerr(P, P_error, eps)
+      P = max(eps, P)
+      logprob_models[sidx,modelidx] = np.log(P) + logmaxP + lognorm
+
+  return (logprob_models, logerr)
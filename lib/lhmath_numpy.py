@@ -0,0 +1,120 @@
+import numpy as np
+import scipy.special
+
+from common import Models, NUM_MODELS, _EPSILON
+import binom
+import util
+
+# Without Numba, `lh.calc_lh_quad` integrates by calling Python functions from
+# `scipy.integrate.quad` once per point, which is orders of magnitude slower
+# than the compiled kernel. Instead, evaluate the integrands for all samples
+# and models of a pair at once with NumPy, using composite Gauss-Legendre
+# quadrature over a fixed number of panels per sample.
+#
+# The integrands are sharply peaked for deeply sequenced variants, so a fixed
+# rule over [0, 1] would miss them. Instead, we place panel boundaries at
+# several multiples of the binomial standard deviation around each variant's
+# phi estimate, where its likelihood is concentrated. Variant 2's beta CDF
+# changes quickly in the same places, or (for diff_branches, whose upper limit
+# is 1 - phi1) in their reflection about 0.5, so we add those too. Within each
+# panel, the integrand is then smooth enough for a low-order rule.
+#
+# Scaling and flooring of each integral follow `lh.calc_lh_quad` exactly, so
+# results differ from it only by quadrature error.
+
+_ORDER = 16
+_SPREADS = np.array([1., 2., 4., 8., 16.])
+
+def _make_rule(order):
+  nodes, weights = np.polynomial.legendre.leggauss(order)
+  return ((nodes + 1) / 2, weights / 2)
+
+_NODES, _WEIGHTS = _make_rule(_ORDER)
+
+def _calc_peak_bounds(V, R, omega):
+  # Return an SxK array of points around the phi estimate for each sample.
+  N = V + R
+  # Smooth the estimate so that the standard deviation isn't zero when `V = 0`
+  # or `V = N`. Floor omega so variants without informative reads (which
+  # `lh.calc_lh` discards anyway) don't produce infinite bounds.
+  omega = np.maximum(omega, 1e-3)
+  P = (V + 0.5) / (N + 1)
+  center = np.minimum(1, P / omega)
+  sd = np.sqrt(P * (1 - P) / (N + 1)) / omega
+  offsets = np.concatenate((-_SPREADS[::-1], [0], _SPREADS))
+  return center[:,None] + sd[:,None]*offsets[None,:]
+
+def _make_nodes(V1, V2):
+  # Return the SxG nodes and weights of the composite rule for each sample.
+  peak1 = _calc_peak_bounds(V1.var_reads, V1.ref_reads, V1.omega_v)
+  peak2 = _calc_peak_bounds(V2.var_reads, V2.ref_reads, V2.omega_v)
+  S = len(peak1)
+  bounds = np.hstack((np.zeros((S, 1)), peak1, peak2, 1 - peak2, np.ones((S, 1))))
+  bounds = np.sort(np.clip(bounds, 0, 1), axis=1)
+  # Panels between duplicate bounds have zero width, and so contribute nothing.
+  lower, width = bounds[:,:-1], np.diff(bounds, axis=1)
+  nodes = lower[:,:,None] + width[:,:,None]*_NODES[None,None,:]
+  weights = width[:,:,None]*_WEIGHTS[None,None,:]
+  return (nodes.reshape(S, -1), weights.reshape(S, -1))
+
+def _binom_logpmf(V, omega, phi):
+  # Evaluate the binomial log-likelihood of the variant in each sample at each
+  # of the SxG values in `phi`.
+  X = np.broadcast_to(V.var_reads[:,None], phi.shape).ravel()
+  N = np.broadcast_to(V.total_reads[:,None], phi.shape).ravel()
+  P = (omega[:,None] * phi).ravel()
+  return binom.logpmf(X.astype(np.float64), N.astype(np.float64), P).reshape(phi.shape)
+
+def _make_limits(phi1, midx):
+  # Limits of the integral over phi2 for each model, as in
+  # `lhmath_native._make_lower` and `lhmath_native._make_upper`.
+  if midx == Models.A_B:
+    return (np.zeros_like(phi1), phi1)
+  elif midx == Models.B_A:
+    return (phi1, np.ones_like(phi1))
+  elif midx == Models.diff_branches:
+    return (np.zeros_like(phi1), 1 - phi1)
+  else:
+    raise Exception('Unknown model')
+
+def _calc_cdf_diff(V2, phi1, midx):
+  A = (V2.var_reads + 1)[:,None]
+  B = (V2.ref_reads + 1)[:,None]
+  omega = V2.omega_v[:,None]
+  lower, upper = _make_limits(phi1, midx)
+  betainc_upper = scipy.special.betainc(A, B, omega * upper)
+  betainc_lower = scipy.special.betainc(A, B, omega * lower)
+  return np.where(np.isclose(betainc_upper, betainc_lower), 0, betainc_upper - betainc_lower)
+
+def _integrate(logf, diff, weights):
+  # Integrate `exp(logf) * diff` over each row, where the first column holds
+  # the integrand at V1's phi estimate, which (as in `lh.calc_lh_quad`) is
+  # used to scale the integral.
+  f = np.exp(logf) * diff
+  logsub = np.log(f[:,0] + _EPSILON)
+  P = np.sum(weights * np.exp(logf[:,1:] - logsub[:,None]) * diff[:,1:], axis=1)
+  return np.log(np.maximum(_EPSILON, P)) + logsub
+
+def calc_lh_pair(V1, V2):
+  '''Compute the SxM log evidence for each model of `V1` and `V2` in each
+  sample, as `lh.calc_lh_quad` does. Garbage evidence is left as NaN.'''
+  S = len(V1.omega_v)
+  nodes, weights = _make_nodes(V1, V2)
+  V1_phi_mle = np.maximum(0, np.minimum(1, V1.vaf / V1.omega_v))
+  # Prepend V1's phi estimate, at which each integrand is evaluated to scale
+  # the integral, to the quadrature nodes.
+  phi1 = np.hstack((V1_phi_mle[:,None], nodes))
+
+  logprob_models = np.full((S, NUM_MODELS), np.nan)
+  logb1 = _binom_logpmf(V1, V1.omega_v, phi1)
+  logb2 = _binom_logpmf(V2, V2.omega_v, phi1)
+  logprob_models[:,Models.cocluster] = _integrate(logb1 + logb2, np.ones_like(phi1), weights)
+
+  lognorm = scipy.special.betaln(V2.var_reads + 1, V2.ref_reads + 1) + \
+    np.log(2) + \
+    util.log_N_choose_K(V2.total_reads, V2.var_reads) - \
+    np.log(V2.omega_v)
+  for midx in (Models.A_B, Models.B_A, Models.diff_branches):
+    diff = _calc_cdf_diff(V2, phi1, midx)
+    logprob_models[:,midx] = _integrate(logb1, diff, weights) + lognorm
+  return logprob_models
@@ -1,22 +1,244 @@
 from collections import namedtuple
 import numpy as np
+import os
 import common
 from common import Models, NUM_MODELS, ALL_MODELS
 import util
 
 Mutrel = namedtuple('Mutrel', ('vids', 'rels'))
 
-def init_mutrel(vids):
+# Index order that swaps the A_B and B_A entries of a relation vector, such
+# that `rels[B,A] == rels[A,B][SWAP_A_B]`.
+SWAP_A_B = np.array([
+  Models.B_A if M == Models.A_B else Models.A_B if M == Models.B_A else M
+  for M in range(NUM_MODELS)
+])
+
+class PackedRels:
+  # Since `rels[B,A]` is just `rels[A,B]` with the A_B and B_A entries swapped,
+  # we need store only the upper triangle (including the diagonal) of the MxMx5
+  # tensor, optionally at reduced precision. `data` holds the upper triangle in
+  # row-major order, such that row `i` contributes entries `(i, i)` through
+  # `(i, M-1)`.
+  #
+  # Indexing mimics that of a dense MxMx5 array for the patterns we use:
+  # `rels[A,B]`, `rels[A,:,model]`, `rels[:,:,models]`, `rels[np.ix_(I,J)]`,
+  # and paired index arrays `rels[I,J]`. Values are always returned as float64,
+  # regardless of the storage dtype. Anything else (e.g., `np.sum(rels,
+  # axis=2)`) goes through `__array__`, which expands to dense form.
+
+  def __init__(self, data):
+    M = int(np.round((np.sqrt(8*len(data) + 1) - 1) / 2))
+    assert data.shape == (M*(M + 1) // 2, NUM_MODELS)
+    self.data = data
+    self._M = M
+    self._row_starts = M*np.arange(M) - (np.arange(M)*(np.arange(M) - 1)) // 2
+
+  @classmethod
+  def empty(cls, M, dtype=np.float64):
+    return cls(np.full((M*(M + 1) // 2, NUM_MODELS), np.nan, dtype=dtype))
+
+  @classmethod
+  def from_dense(cls, rels, dtype=np.float64):
+    M = len(rels)
+    assert rels.shape == (M, M, NUM_MODELS)
+    packed = cls.empty(M, dtype)
+    for idx in range(M):
+      packed.data[packed._row_slice(idx)] = rels[idx,idx:]
+    return packed
+
+  @property
+  def shape(self):
+    return (self._M, self._M, NUM_MODELS)
+
+  @property
+  def ndim(self):
+    return 3
+
+  @property
+  def dtype(self):
+    return self.data.dtype
+
+  def __len__(self):
+    return self._M
+
+  def _row_slice(self, idx):
+    start = self._row_starts[idx]
+    return slice(start, start + self._M - idx)
+
+  def _gather(self, I, J):
+    # `I` and `J` must be integer arrays of the same shape.
+    lo, hi = np.minimum(I, J), np.maximum(I, J)
+    vals = self.data[self._row_starts[lo] + (hi - lo)].astype(np.float64)
+    swapped = I > J
+    vals[swapped] = vals[swapped][...,SWAP_A_B]
+    return vals
+
+  def _normalize(self, idx):
+    if isinstance(idx, slice):
+      return np.arange(self._M)[idx]
+    return np.asarray(idx)
+
+  def __getitem__(self, key):
+    if not isinstance(key, tuple):
+      key = (key,)
+    key = key + (slice(None),)*(3 - len(key))
+    I, J, models = key
+    if isinstance(models, (tuple, list)):
+      models = np.array(models)
+
+    basic = all([isinstance(idx, (slice, int, np.integer)) for idx in (I, J)])
+    I, J = self._normalize(I), self._normalize(J)
+    if basic:
+      # Take the outer product of `I` and `J`, as with dense basic indexing.
+      # Gather one row at a time, to avoid building MxM index arrays.
+      vals = np.array([self._gather(np.full(J.shape, row), J)[...,models] for row in np.atleast_1d(I)])
+      return vals[0] if I.ndim == 0 else vals
+    I, J = np.broadcast_arrays(I, J)
+    return self._gather(I, J)[...,models]
+
+  def __setitem__(self, key, vals):
+    # Only paired assignment (`rels[I,J] = vals`, with `vals` of shape
+    # (len(I), 5)) is supported.
+    I, J = [np.atleast_1d(self._normalize(idx)) for idx in key]
+    vals = np.array(vals, dtype=np.float64).reshape(I.shape + (NUM_MODELS,))
+    swapped = I > J
+    vals[swapped] = vals[swapped][...,SWAP_A_B]
+    lo, hi = np.minimum(I, J), np.maximum(I, J)
+    self.data[self._row_starts[lo] + (hi - lo)] = vals
+
+  def __array__(self, dtype=None):
+    return self.to_dense().astype(dtype) if dtype is not None else self.to_dense()
+
+  def to_dense(self):
+    M = self._M
+    dense = np.zeros((M, M, NUM_MODELS))
+    for idx in range(M):
+      row = self.data[self._row_slice(idx)]
+      dense[idx,idx:] = row
+      dense[idx:,idx] = row[:,SWAP_A_B]
+    return dense
+
+  def take(self, order):
+    '''Return a new `PackedRels` containing only the variants in `order`, in
+    that order.'''
+    order = np.asarray(order)
+    taken = PackedRels.empty(len(order), self.dtype)
+    for idx in range(len(order)):
+      taken.data[taken._row_slice(idx)] = self._gather(np.full(len(order) - idx, order[idx]), order[idx:])
+    return taken
+
+# Name of the file holding the packed relations of a memory-mapped mutrel
+# within its directory.
+MEMMAP_RELS = 'rels.npy'
+
+def create_memmap_rels(dirname, M, dtype=np.float64):
+  '''Create `PackedRels` for `M` variants whose data is stored in a
+  memory-mapped file in `dirname`, so that it needn't fit in memory. Entries
+  are initially zero.'''
+  os.makedirs(dirname, exist_ok=True)
+  data = np.lib.format.open_memmap(os.path.join(dirname, MEMMAP_RELS), mode='w+', dtype=dtype, shape=(M*(M + 1) // 2, NUM_MODELS))
+  return PackedRels(data)
+
+def load_memmap_rels(dirname, mode='r'):
+  data = np.lib.format.open_memmap(os.path.join(dirname, MEMMAP_RELS), mode=mode)
+  return PackedRels(data)
+
+def iter_row_tiles(rels, tile_size=2**22):
+  '''Yield `(rows, tile)` for contiguous ranges of rows covering `rels`, which
+  may be dense or packed, where `tile` is the dense array `rels[rows]`. Each
+  tile holds about `tile_size` pairs, so that memory use for packed or
+  memory-mapped relations is proportional to `tile_size` rather than M^2.'''
+  M = len(rels)
+  rows_per_tile = max(1, tile_size // max(1, M))
+  for start in range(0, M, rows_per_tile):
+    rows = np.arange(start, min(M, start + rows_per_tile))
+    yield (rows, np.asarray(rels[start:rows[-1] + 1], dtype=np.float64))
+
+def _iter_chunks(data, chunk_size=2**20):
+  # Iterate over the packed `data` in chunks, so that temporaries used in
+  # checking it (e.g., boolean masks) don't scale with M^2.
+  for start in range(0, len(data), chunk_size):
+    yield data[start:start + chunk_size]
+
+def is_packed(mrel):
+  return isinstance(mrel.rels, PackedRels)
+
+def pack_mutrel(mrel, dtype=np.float64):
+  if is_packed(mrel):
+    rels = PackedRels(mrel.rels.data.astype(dtype))
+  else:
+    rels = PackedRels.from_dense(mrel.rels, dtype)
+  return Mutrel(vids=list(mrel.vids), rels=rels)
+
+def unpack_mutrel(mrel):
+  if not is_packed(mrel):
+    return mrel
+  return Mutrel(vids=list(mrel.vids), rels=mrel.rels.to_dense())
+
+def init_mutrel(vids, packed=False, dtype=np.float64):
   M = len(vids)
-  mrel = Mutrel(vids=list(vids), rels=np.nan*np.ones((M, M, NUM_MODELS)))
+  if packed:
+    rels = PackedRels.empty(M, dtype)
+  else:
+    rels = np.nan*np.ones((M, M, NUM_MODELS))
+  mrel = Mutrel(vids=list(vids), rels=rels)
   return mrel
 
+def _has_spare_capacity(rels, M):
+  # Check whether `rels` is the leading corner of a larger backing array
+  # created by `grow_mutrel`, with room for `M` variants.
+  base = rels.base
+  return isinstance(base, np.ndarray) and \
+    base.ndim == rels.ndim and \
+    base.shape[0] >= M and \
+    base.shape[2:] == rels.shape[2:] and \
+    base.strides == rels.strides and \
+    base.__array_interface__['data'][0] == rels.__array_interface__['data'][0]
+
+def grow_mutrel(mrel, new_vids, growth=2.):
+  '''Return a mutrel for `mrel.vids + new_vids`, with the existing relations
+  copied and those involving the new variants set to NaN. `rels` may have
+  trailing dimensions beyond the first two (e.g., per-sample evidence).
+
+  The returned `rels` is a view onto a backing array with spare capacity, which
+  grows by a factor of `growth` when exhausted, so that growing a mutrel one
+  wave of variants at a time copies each entry only a constant number of times
+  on average. When there is spare capacity, the new relations are written into
+  the same backing array, so `mrel` must not be grown again afterwards.
+
+  The spare capacity lasts only as long as the returned mutrel. Saving it with
+  `resultserializer.Results.add_mutrel` stores only the relations themselves,
+  so a mutrel loaded from disk has no spare capacity, and is copied in full
+  when first grown. Thus, the savings apply only to waves added within one
+  process, not to waves added by separate runs of `util/add_variants.py`.'''
+  assert not is_packed(mrel), 'Packed mutrels cannot be grown'
+  assert len(set(new_vids) & set(mrel.vids)) == 0
+  M_old = len(mrel.vids)
+  M = M_old + len(new_vids)
+  rels = mrel.rels
+
+  if _has_spare_capacity(rels, M):
+    base = rels.base
+  else:
+    capacity = max(M, int(np.ceil(growth * M_old)))
+    base = np.empty((capacity, capacity) + rels.shape[2:], dtype=rels.dtype)
+    base[:M_old,:M_old] = rels
+  grown = base[:M,:M]
+  grown[M_old:] = np.nan
+  grown[:,M_old:] = np.nan
+  return Mutrel(vids=list(mrel.vids) + list(new_vids), rels=grown)
+
 def remove_variants_by_vidx(mrel, vidxs):
   # Make set for efficient `in`.
   vidxs = set(vidxs)
+  if is_packed(mrel):
+    rels = mrel.rels.take([vidx for vidx in range(len(mrel.vids)) if vidx not in vidxs])
+  else:
+    rels = util.remove_rowcol(mrel.rels, vidxs)
   return Mutrel(
     vids = [vid for vidx, vid in enumerate(mrel.vids) if vidx not in vidxs],
-    rels = util.remove_rowcol(mrel.rels, vidxs),
+    rels = rels,
   )
 
 def sort_mutrel_by_vids(mrel):
@@ -29,11 +251,16 @@ def sort_mutrel_by_vids(mrel):
   assert sorted_vids == [mrel.vids[idx] for idx in order]
   return Mutrel(
     vids = sorted_vids,
-    rels = reorder_array(mrel.rels, order),
+    rels = mrel.rels.take(order) if is_packed(mrel) else reorder_array(mrel.rels, order),
   )
 
 def check_mutrel_sanity(mrel):
   '''Check properties that should be true of all mutrel arrays.'''
+  if isinstance(mrel, PackedRels):
+    # Symmetry is guaranteed by the packed representation.
+    for chunk in _iter_chunks(mrel.data):
+      assert not np.any(np.isnan(chunk))
+    return
   assert not np.any(np.isnan(mrel))
   for model in ('garbage', 'cocluster', 'diff_branches'):
     # These should be symmetric.
@@ -43,8 +270,12 @@ def check_mutrel_sanity(mrel):
 
 def check_posterior_sanity(posterior):
   check_mutrel_sanity(posterior)
-  assert np.all(0 <= posterior) and np.all(posterior <= 1)
-  assert np.allclose(1, np.sum(posterior, axis=2))
+  # For packed posteriors, check the stored entries rather than expanding to
+  # dense form.
+  chunks = _iter_chunks(posterior.data) if isinstance(posterior, PackedRels) else (posterior,)
+  for vals in chunks:
+    assert np.all(0 <= vals) and np.all(vals <= 1)
+    assert np.allclose(1, np.sum(vals, axis=-1))
 
   diag = range(len(posterior))
   noncocluster = [getattr(Models, M) for M in ALL_MODELS if M != 'cocluster']
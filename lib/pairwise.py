@@ -1,13 +1,24 @@
 import numpy as np
 import scipy.special
+import scipy.sparse
 import concurrent.futures
 from progressbar import progressbar
 import itertools
+import sys
+import functools
 
 from common import Models, NUM_MODELS, ALL_MODELS
+from mutrel import SWAP_A_B
 import common
 import lh
+import lh_grid
+import lh_tiered
 import mutrel
+import shared_arrays
+
+# Methods that compute the likelihood of each pair separately, as opposed to
+# `grid`, which computes all pairs at once.
+PAIR_METHODS = ('quad', 'numba', 'numpy')
 
 def swap_A_B(arr):
   swapped = np.zeros(len(arr)) + np.nan
@@ -40,9 +51,34 @@ def _calc_posterior(evidence, logprior):
   posterior = np.exp(joint) / np.sum(np.exp(joint))
   return posterior
 
+def _calc_posterior_packed(evidence, logprior, chunk_size=2**20):
+  # Computing the posterior commutes with swapping A_B and B_A only if both
+  # relations have the same prior, which is necessary to store the posterior
+  # in packed form.
+  assert logprior[Models.A_B] == logprior[Models.B_A]
+  posterior = mutrel.PackedRels.empty(len(evidence), evidence.dtype)
+
+  # Work on chunks of pairs so that temporaries don't scale with M^2.
+  for start in range(0, len(evidence.data), chunk_size):
+    joint = evidence.data[start:start + chunk_size].astype(np.float64) + logprior[None,:]
+    joint -= np.max(joint, axis=1)[:,None]
+    expjoint = np.exp(joint)
+    posterior.data[start:start + chunk_size] = expjoint / np.sum(expjoint, axis=1)[:,None]
+
+  # Entries for pairs consisting of the same variant twice fall at the start of
+  # each packed row.
+  diag = [posterior._row_slice(idx).start for idx in range(len(posterior))]
+  posterior.data[diag] = 0
+  posterior.data[diag,Models.cocluster] = 1
+
+  mutrel.check_posterior_sanity(posterior)
+  return posterior
+
 def _calc_posterior_full(evidence, logprior):
-  # This function is currently used only to double-check the results of
-  # `_calc_posterior`.
+  # This function is used to compute the full posterior from the evidence
+  # tensor, and to double-check the results of `_calc_posterior`.
+  if isinstance(evidence, mutrel.PackedRels):
+    return _calc_posterior_packed(evidence, logprior)
   joint = evidence + logprior[None,None,:]
   diag = range(len(joint))
   joint[diag,diag,:] = -np.inf
@@ -56,6 +92,21 @@ def _calc_posterior_full(evidence, logprior):
   mutrel.check_posterior_sanity(posterior)
   return posterior
 
+def calc_posterior_tile(evidence, logprior, rows):
+  '''Compute the posterior for `evidence`, an RxMx5 tile holding rows `rows`
+  of an MxMx5 evidence tensor (e.g., as yielded by `mutrel.iter_row_tiles`).
+  This matches the corresponding rows of `make_full_posterior`.'''
+  logprior = _complete_logprior(dict(logprior))
+  joint = evidence + logprior[None,None,:]
+  idxs = np.arange(len(rows))
+  joint[idxs,rows,:] = -np.inf
+  joint[idxs,rows,Models.cocluster] = 0
+
+  B = np.max(joint, axis=2)
+  joint -= B[:,:,None]
+  expjoint = np.exp(joint)
+  return expjoint / np.sum(expjoint, axis=2)[:,:,None]
+
 def make_full_posterior(evidence, logprior):
   logprior = _complete_logprior(logprior)
   posterior = mutrel.Mutrel(
@@ -96,55 +147,372 @@ def _complete_logprior(logprior):
   assert np.isclose(0, scipy.special.logsumexp(logprior_vals))
   return logprior_vals
 
-def _compute_pairs(pairs, variants, logprior, posterior, evidence, pbar=None, parallel=1):
-  logprior = _complete_logprior(logprior)
-  # TODO: change ordering of pairs based on what will provide optimal
-  # integration accuracy according to Quaid's advice.
-  pairs = list(pairs)
+def _make_blocks(pairs, block_size):
+  # Group pairs into blocks spanning contiguous rows (i.e., contiguous values
+  # of the first variant in each pair), with each block containing at least
+  # `block_size` pairs (save for the last).
+  blocks = []
+  current = []
+  for A, row in itertools.groupby(sorted(pairs), key=lambda pair: pair[0]):
+    current += list(row)
+    if len(current) >= block_size:
+      blocks.append(np.array(current))
+      current = []
+  if len(current) > 0:
+    blocks.append(np.array(current))
+  return blocks
+
+def _choose_block_size(num_pairs, parallel):
+  # Aim for several blocks per worker so that load remains balanced, but cap
+  # the block size so that progress is reported reasonably often.
+  return int(max(1, min(2048, np.ceil(num_pairs / (8*max(1, parallel))))))
+
+# Rather than pickling the variants for every task, publish their read counts
+# in shared memory once, so that tasks need only contain variant indices.
+# Workers write their results into slots of shared result buffers, so those
+# needn't be pickled either.
+_worker_shared = None
+_worker_variants = None
+_worker_garbage_terms = None
+_worker_memo = None
+_worker_tiered = None
+
+_VARIANT_FIELDS = ('var_reads', 'ref_reads', 'total_reads', 'vaf', 'omega_v')
+
+def _publish_variants(shared, variants, garbage_terms):
+  for K in _VARIANT_FIELDS:
+    mat = np.array([getattr(V, K) for V in variants])
+    shared.create(K, mat.shape, mat.dtype, mat)
+  shared.create('garbage_terms', garbage_terms.shape, garbage_terms.dtype, garbage_terms)
+
+def _init_worker(specs, vids, memo, tiered):
+  global _worker_shared, _worker_variants, _worker_garbage_terms, _worker_memo, _worker_tiered
+  _worker_shared = shared_arrays.SharedArrays.attach(specs)
+  mats = _worker_shared.arrays
+  _worker_variants = [
+    common.Variant(id=vid, **{K: mats[K][idx] for K in _VARIANT_FIELDS})
+    for idx, vid in enumerate(vids)
+  ]
+  _worker_garbage_terms = mats['garbage_terms']
+  _worker_memo = memo
+  _worker_tiered = tiered
+
+def _calc_garbage_terms(variants):
+  # Garbage evidence terms depend on only a single variant, so compute them
+  # once for each variant, yielding an MxSx4 array.
+  return np.array([lh.calc_garbage_terms(V) for V in variants])
+
+def _calc_block(block, logprior, per_sample=False, variants=None, garbage_terms=None, memo=None, lh_method='quad', tiered=None):
+  if variants is None:
+    variants = _worker_variants
+    garbage_terms = _worker_garbage_terms
+    memo = _worker_memo
+    tiered = _worker_tiered
+  if memo is not None:
+    hits, misses = memo.counts()
+  S = len(variants[0].omega_v)
+  evidence = np.zeros((len(block), NUM_MODELS))
+  posterior = np.zeros((len(block), NUM_MODELS))
+  # Only return per-sample evidence if requested, as it's S times bigger.
+  evidence_per_sample = np.zeros((len(block), S, NUM_MODELS)) if per_sample else None
+  tiers = np.zeros(len(block), dtype=np.int8) if tiered is not None else None
+  garbage = lh.combine_garbage_terms(garbage_terms[block[:,0]], garbage_terms[block[:,1]])
+  for idx, (A, B) in enumerate(block):
+    E, Es, P, tier = _calc_lh_and_posterior(variants[A], variants[B], logprior, garbage[idx], memo, lh_method, tiered)
+    evidence[idx], posterior[idx] = E, P
+    if per_sample:
+      evidence_per_sample[idx] = Es
+    if tiered is not None:
+      tiers[idx] = tier
+  # Report how the memo fared on this block, so that the parent can total the
+  # counts across workers.
+  memo_counts = (memo.hits - hits, memo.misses - misses) if memo is not None else None
+  return (evidence, posterior, evidence_per_sample, memo_counts, tiers)
+
+def _calc_block_shared(block, slot, logprior, per_sample, lh_method):
+  evidence, posterior, evidence_per_sample, memo_counts, tiers = _calc_block(block, logprior, per_sample, lh_method=lh_method)
+  results = _worker_shared.arrays
+  results['evidence'][slot,:len(block)] = evidence
+  results['posterior'][slot,:len(block)] = posterior
+  if per_sample:
+    results['evidence_per_sample'][slot,:len(block)] = evidence_per_sample
+  return (memo_counts, tiers)
+
+def _run_blocks(blocks, variants, garbage_terms, logprior, per_sample, parallel, memo=None, lh_method='quad', tiered=None):
+  # Compute each block of pairs, yielding the block along with its evidence,
+  # posterior, per-sample evidence, and integration tiers as each completes.
+  #
   # Don't bother starting more workers than jobs.
-  parallel = min(parallel, len(pairs))
+  parallel = min(parallel, len(blocks))
 
   # If you set parallel = 0, we don't invoke the parallelism machinery. This
   # makes debugging easier.
   if parallel > 0:
-    futures = []
-    with concurrent.futures.ProcessPoolExecutor(max_workers=parallel) as ex:
-      for A, B in pairs:
-        futures.append(ex.submit(_calc_lh_and_posterior, variants[A], variants[B], logprior))
-      if pbar is not None:
-        for F in concurrent.futures.as_completed(futures):
-          pbar.update()
-    for (A, B), F in zip(pairs, futures):
-      evidence.rels[A,B], posterior.rels[A,B] = F.result()
+    # Limit the number of blocks in flight, so that the parent's memory use
+    # doesn't depend on the total number of pairs. Each block in flight gets
+    # its own slot in the shared result buffers.
+    max_pending = 2*parallel
+    max_block = max([len(block) for block in blocks])
+    S = len(variants[0].omega_v)
+    remaining = iter(blocks)
+    pending = {}
+    free_slots = list(range(max_pending))
+    if lh_method == 'numba':
+      # Compile the kernel before forking, so that workers don't each have to.
+      lh.calc_lh_numba(variants[0], variants[0])
+
+    with shared_arrays.SharedArrays() as shared:
+      _publish_variants(shared, variants, garbage_terms)
+      shared.create('evidence', (max_pending, max_block, NUM_MODELS), np.float64)
+      shared.create('posterior', (max_pending, max_block, NUM_MODELS), np.float64)
+      if per_sample:
+        shared.create('evidence_per_sample', (max_pending, max_block, S, NUM_MODELS), np.float64)
+
+      with concurrent.futures.ProcessPoolExecutor(max_workers=parallel, initializer=_init_worker, initargs=(shared.specs, [V.id for V in variants], memo, tiered)) as ex:
+        def _submit(block):
+          slot = free_slots.pop()
+          pending[ex.submit(_calc_block_shared, block, slot, logprior, per_sample, lh_method)] = (block, slot)
+
+        for block in itertools.islice(remaining, max_pending):
+          _submit(block)
+        while len(pending) > 0:
+          done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+          for F in done:
+            block, slot = pending.pop(F)
+            memo_counts, block_tiers = F.result()
+            if memo is not None:
+              memo.add_counts(*memo_counts)
+            # Copy results out of the slot so it can be reused, and so that no
+            # views onto shared memory outlive it.
+            block_evidence = np.copy(shared.arrays['evidence'][slot,:len(block)])
+            block_posterior = np.copy(shared.arrays['posterior'][slot,:len(block)])
+            block_per_sample = np.copy(shared.arrays['evidence_per_sample'][slot,:len(block)]) if per_sample else None
+            free_slots.append(slot)
+            yield (block, block_evidence, block_posterior, block_per_sample, block_tiers)
+          for block in itertools.islice(remaining, len(done)):
+            _submit(block)
   else:
-    for A, B in pairs:
-      evidence.rels[A,B], posterior.rels[A,B] = _calc_lh_and_posterior(variants[A], variants[B], logprior)
+    for block in blocks:
+      # The memo is used directly here, so its counts are already up to date.
+      block_evidence, block_posterior, block_per_sample, _, block_tiers = _calc_block(block, logprior, per_sample, variants, garbage_terms, memo, lh_method, tiered)
+      yield (block, block_evidence, block_posterior, block_per_sample, block_tiers)
+
+def _store_block(block, block_evidence, block_posterior, block_per_sample, evidence, posterior, evidence_per_sample):
+  A, B = block[:,0], block[:,1]
+  offdiag = A != B
+
+  evidence.rels[A,B] = block_evidence
+  posterior.rels[A,B] = block_posterior
+  evidence.rels[B[offdiag],A[offdiag]] = block_evidence[offdiag][:,SWAP_A_B]
+  posterior.rels[B[offdiag],A[offdiag]] = block_posterior[offdiag][:,SWAP_A_B]
+
+  if evidence_per_sample is not None:
+    evidence_per_sample.rels[A,B] = block_per_sample
+    evidence_per_sample.rels[B[offdiag],A[offdiag]] = block_per_sample[offdiag][:,:,SWAP_A_B]
+
+def _fetch_cached(pairs, hashes, logprior, cache, posterior, evidence):
+  # Pairs consisting of the same variant twice are trivial to compute, so don't
+  # bother caching them.
+  candidates = np.array([(A, B) for A, B in pairs if A != B], dtype=int).reshape(-1, 2)
+  cached = cache.get(candidates, hashes)
+  hit = np.logical_not(np.any(np.isnan(cached), axis=1))
+
+  cached_posterior = np.array([_calc_posterior(E, logprior) for E in cached[hit]]).reshape(-1, NUM_MODELS)
+  _store_block(candidates[hit], cached[hit], cached_posterior, None, evidence, posterior, None)
+
+  hits = set(map(tuple, candidates[hit]))
+  misses = [(A, B) for A, B in pairs if (A, B) not in hits]
+  return (misses, len(hits))
+
+def _screen_pairs(pairs, variants, garbage_terms, logprior, screen, posterior, evidence, evidence_per_sample):
+  candidates = np.array([(A, B) for A, B in pairs if A != B], dtype=int).reshape(-1, 2)
+  decisive, fast_evidence, fast_per_sample = screen.screen(candidates, variants, garbage_terms)
+  fast_posterior = np.array([_calc_posterior(E, logprior) for E in fast_evidence]).reshape(-1, NUM_MODELS)
+  _store_block(candidates[decisive], fast_evidence, fast_posterior, fast_per_sample, evidence, posterior, evidence_per_sample)
+
+  fast = set(map(tuple, candidates[decisive]))
+  uncertain = [(A, B) for A, B in pairs if (A, B) not in fast]
+  return (uncertain, len(fast))
+
+def make_evidence_settings(lh_method, screen=None, tiered=None):
+  '''Return a dict of the settings besides the variants that affect the
+  evidence computed by `calc_posterior` and its relatives, so that evidence
+  stored by one run can be checked before another reuses it.'''
+  return {
+    'method': lh_method,
+    'decisive_alpha': screen.stats()['alpha'] if screen is not None else None,
+    'tiered_tol': tiered.stats()['tol'] if tiered is not None else None,
+  }
+
+def _make_checkpoint_settings(logprior, lh_method, screen, tiered):
+  # Evidence checkpointed with other settings can't be reused. The evidence
+  # doesn't depend on the prior, but the restored posterior does, so include it
+  # too.
+  settings = make_evidence_settings(lh_method, screen, tiered)
+  settings['logprior'] = [float(P) for P in logprior]
+  return settings
+
+def _resume_checkpoint(pairs, variants, logprior, checkpoint, settings, posterior, evidence, evidence_per_sample):
+  checkpoint.restore(variants, settings, evidence, evidence_per_sample)
+  pairs = np.array(pairs, dtype=int).reshape(-1, 2)
+  restored = evidence.rels[pairs[:,0],pairs[:,1]]
+  done = np.logical_not(np.any(np.isnan(restored), axis=1))
+
+  restored_posterior = np.array([_calc_posterior(E, logprior) for E in restored[done]]).reshape(-1, NUM_MODELS)
+  _store_block(pairs[done], restored[done], restored_posterior, None, evidence, posterior, None)
+  checkpoint.restored = int(np.sum(done))
+  return ([(A, B) for A, B in pairs[~done]], checkpoint.restored)
+
+def _compute_pairs(pairs, variants, logprior, posterior, evidence, pbar=None, parallel=1, block_size=None, evidence_per_sample=None, cache=None, screen=None, memo=None, checkpoint=None, lh_method='quad', tiered=None):
+  logprior = _complete_logprior(logprior)
+  # TODO: change ordering of pairs based on what will provide optimal
+  # integration accuracy according to Quaid's advice.
+  pairs = list(pairs)
 
-  # Duplicate evidence's keys, since we'll be modifying dictionary.
-  for A, B in pairs:
-    if A == B:
-      continue
-    evidence.rels[B,A] = swap_A_B(evidence.rels[A,B])
-    posterior.rels[B,A] = swap_A_B(posterior.rels[A,B])
+  if checkpoint is not None:
+    settings = _make_checkpoint_settings(logprior, lh_method, screen, tiered)
+    pairs, num_restored = _resume_checkpoint(pairs, variants, logprior, checkpoint, settings, posterior, evidence, evidence_per_sample)
+    if pbar is not None and num_restored > 0:
+      pbar.update(num_restored)
+
+  # The cache stores only evidence summed across samples, so it can't be used
+  # when per-sample evidence is requested.
+  use_cache = cache is not None and evidence_per_sample is None
+  if use_cache:
+    hashes = cache.hash_variants(variants)
+    pairs, num_hits = _fetch_cached(pairs, hashes, logprior, cache, posterior, evidence)
+    if pbar is not None and num_hits > 0:
+      pbar.update(num_hits)
+  garbage_terms = _calc_garbage_terms(variants)
+  # Screened pairs are computed after consulting the cache, and aren't added to
+  # it, since their evidence is only approximate.
+  if screen is not None:
+    pairs, num_fast = _screen_pairs(pairs, variants, garbage_terms, logprior, screen, posterior, evidence, evidence_per_sample)
+    if pbar is not None and num_fast > 0:
+      pbar.update(num_fast)
+  if block_size is None:
+    block_size = _choose_block_size(len(pairs), parallel)
+  blocks = _make_blocks(pairs, block_size)
+  per_sample = evidence_per_sample is not None
+
+  if tiered is not None:
+    tiered.init_tiers(len(variants))
+
+  for block, block_evidence, block_posterior, block_per_sample, block_tiers in _run_blocks(blocks, variants, garbage_terms, logprior, per_sample, parallel, memo, lh_method, tiered):
+    _store_block(block, block_evidence, block_posterior, block_per_sample, evidence, posterior, evidence_per_sample)
+    if tiered is not None:
+      tiered.record(block, block_tiers)
+    if checkpoint is not None:
+      checkpoint.update(evidence, evidence_per_sample)
+    if pbar is not None:
+      pbar.update(len(block))
+
+  if use_cache:
+    computed = np.array([(A, B) for A, B in pairs if A != B], dtype=int).reshape(-1, 2)
+    if tiered is not None:
+      # As with screened pairs, evidence from the fixed tier is only
+      # approximate, so it isn't added to the cache.
+      computed = computed[tiered.tiers[computed[:,0],computed[:,1]] != lh_tiered.TIER_FIXED]
+    cache.put(computed, hashes, evidence.rels[computed[:,0],computed[:,1]])
 
   mutrel.check_mutrel_sanity(evidence.rels)
   mutrel.check_posterior_sanity(posterior.rels)
-  assert np.all(np.isclose(1, np.sum(posterior.rels, axis=2)))
+  if checkpoint is not None:
+    checkpoint.clear()
 
   # TODO: only calculate posterior once here, instead of computing it within
   # each worker separately for a given variant pair.
   other = _calc_posterior_full(evidence.rels, logprior)
-  assert np.allclose(posterior.rels, other)
+  if mutrel.is_packed(posterior):
+    assert np.allclose(posterior.rels.data, other.data)
+  else:
+    assert np.all(np.isclose(1, np.sum(posterior.rels, axis=2)))
+    assert np.allclose(posterior.rels, other)
+  return (posterior, evidence)
+
+def _calc_posterior_grid(variants, logprior, rel_type, grid_points, grid_tol, parallel, per_sample, packed, dtype):
+  vids = common.extract_vids(variants)
+  variants = [common.convert_variant_dict_to_tuple(variants[V]) for V in vids]
+  M, S = len(variants), len(variants[0].omega_v)
+
+  _compute = lambda pbar: lh_grid.calc_evidence(variants, grid_points, pbar=pbar, per_sample=per_sample, packed=packed, dtype=dtype)
+  if parallel > 0:
+    with progressbar(total=lh_grid.count_blocks(M, S), desc='Computing %s relations' % rel_type, unit='block', dynamic_ncols=True) as pbar:
+      evidence = _compute(pbar)
+  else:
+    evidence = _compute(None)
+
+  if per_sample:
+    evidence_per_sample = mutrel.Mutrel(vids=vids, rels=evidence)
+    evidence = sum_evidence_per_sample(evidence_per_sample)
+  else:
+    evidence = mutrel.Mutrel(vids=vids, rels=evidence)
+  mutrel.check_mutrel_sanity(evidence.rels)
+  posterior = make_full_posterior(evidence, logprior)
+  if grid_tol is not None:
+    lh_grid.check_against_quad(variants, posterior.rels, _complete_logprior(logprior), grid_tol)
+
+  if per_sample:
+    return (posterior, evidence, evidence_per_sample)
   return (posterior, evidence)
 
-def calc_posterior(variants, logprior, rel_type, parallel=1):
+def calc_posterior(variants, logprior, rel_type, parallel=1, method='quad', grid_points=2001, grid_tol=None, per_sample=False, cache=None, packed=False, dtype=np.float64, screen=None, memo=None, checkpoint=None, tiered=None):
+  '''
+  The `quad` method integrates each pair with `lh.calc_lh_quad`, while `numba`
+  uses the compiled kernel in `lh.calc_lh_numba`, which is faster but must be
+  compiled once per run. The `numpy` method uses the vectorized quadrature in
+  `lh.calc_lh_numpy`, which needs no compilation; if Numba is disabled, it's
+  also used in place of `quad`, which is then orders of magnitude slower. These
+  are the per-pair methods. The `grid` method computes all pairs at once using
+  `lh_grid`.
+
+  If `per_sample` is set, also return an MxMxSx5 tensor of the evidence for each
+  pair in each sample, which can later be summed over any subset of samples
+  using `sum_evidence_per_sample`.
+
+  If `cache` is an `evidence_cache.EvidenceCache`, evidence for pairs already
+  present in it is reused rather than recomputed. The cache is used only with
+  the per-pair methods.
+
+  If `packed` is set, the returned posterior and evidence are stored as
+  `mutrel.PackedRels` with the given `dtype`, which never materializes the
+  dense MxMx5 tensors.
+
+  If `screen` is an `lh_screen.DecisiveScreen`, pairs whose relationship is
+  already settled by their read counts get a closed-form estimate of their
+  evidence rather than being integrated numerically. The screen is used only
+  with the per-pair methods.
+
+  If `memo` is an `lh.QuadMemo`, per-sample integrals are remembered and reused
+  for pairs of variants sharing the same read counts in a sample. The memo is
+  used only with the `quad` method.
+
+  If `checkpoint` is a `pairwise_checkpoint.PairwiseCheckpoint`, evidence
+  computed so far is periodically saved to it, and any evidence it already
+  holds for these variants and settings is reused. The checkpoint is used only
+  with the per-pair methods.
+
+  If `tiered` is an `lh_tiered.TieredIntegration`, each pair is first
+  integrated with a cheap fixed rule, and integrated adaptively only if that
+  could leave its posterior off by more than the tolerance. The tier used for
+  each pair is recorded in `tiered.tiers`. This is used only with the `quad` and
+  `numba` methods.
+  '''
+  assert not (per_sample and packed), 'Per-sample evidence cannot be packed'
+  if method == 'grid':
+    return _calc_posterior_grid(variants, logprior, rel_type, grid_points, grid_tol, parallel, per_sample, packed, dtype)
+  elif method not in PAIR_METHODS:
+    raise Exception('Unknown pairwise method: %s' % method)
+  assert tiered is None or method in ('quad', 'numba'), 'Tiered integration requires the quad or numba method'
+
   M = len(variants)
   # Allow Numba use by converting to namedtuple.
   vids = common.extract_vids(variants)
   variants = [common.convert_variant_dict_to_tuple(variants[V]) for V in vids]
 
-  posterior = mutrel.init_mutrel(vids)
-  evidence = mutrel.init_mutrel(vids)
+  posterior = mutrel.init_mutrel(vids, packed, dtype)
+  evidence = mutrel.init_mutrel(vids, packed, dtype)
+  evidence_per_sample = init_evidence_per_sample(vids, len(variants[0].omega_v)) if per_sample else None
   pairs = list(itertools.combinations(range(M), 2)) + [(V, V) for V in range(M)]
 
   _compute = lambda pbar: _compute_pairs(
@@ -155,6 +523,13 @@ def calc_posterior(variants, logprior, rel_type, parallel=1):
      evidence,
      pbar,
      parallel,
+     evidence_per_sample = evidence_per_sample,
+     cache = cache,
+     screen = screen,
+     memo = memo,
+     checkpoint = checkpoint,
+     lh_method = method,
+     tiered = tiered,
   )
 
   if parallel > 0:
@@ -162,61 +537,231 @@ def calc_posterior(variants, logprior, rel_type, parallel=1):
       posterior, evidence =_compute(pbar)
   else:
     posterior, evidence =_compute(None)
-  return (posterior, evidence)
-
-def merge_variants(to_merge, evidence, logprior):
-  assert np.all(np.array([V for group in to_merge for V in group]) < len(evidence.vids))
-  already_merged = set()
 
-  for vidxs in to_merge:
-    vidxs = set(vidxs)
-    assert len(vidxs & already_merged) == 0
+  if per_sample:
+    return (posterior, evidence, evidence_per_sample)
+  return (posterior, evidence)
 
-    M_old = len(evidence.vids)
-    merged_vid = ','.join([evidence.vids[V] for V in vidxs])
-    new_vids = evidence.vids + [merged_vid]
+def init_evidence_per_sample(vids, S):
+  M = len(vids)
+  return mutrel.Mutrel(vids=list(vids), rels=np.nan*np.ones((M, M, S, NUM_MODELS)))
 
-    new_evidence = mutrel.init_mutrel(new_vids)
-    new_evidence.rels[:-1,:-1] = evidence.rels
+def sum_evidence_per_sample(evidence_per_sample, sample_idxs=None):
+  '''Sum per-sample evidence over `sample_idxs` (or all samples, if not
+  specified), yielding the same evidence tensor as if `calc_posterior` had
+  been run only on those samples.'''
+  if sample_idxs is None:
+    rels = evidence_per_sample.rels
+  else:
+    assert len(sample_idxs) > 0
+    rels = evidence_per_sample.rels[:,:,sample_idxs]
+  return mutrel.Mutrel(
+    vids = evidence_per_sample.vids,
+    rels = np.sum(rels, axis=2),
+  )
 
-    merged_row = np.sum(np.array([evidence.rels[V] for V in vidxs]), axis=0)
-    assert merged_row.shape == (M_old, NUM_MODELS)
-    merged_col = np.copy(merged_row)
-    merged_col[:,Models.A_B] = merged_row[:,Models.B_A]
-    merged_col[:,Models.B_A] = merged_row[:,Models.A_B]
+def concat_evidence_per_sample(first, second):
+  '''Combine per-sample evidence for the same variants computed over two
+  different sets of samples.'''
+  assert first.vids == second.vids
+  return mutrel.Mutrel(
+    vids = first.vids,
+    rels = np.concatenate((first.rels, second.rels), axis=2),
+  )
 
-    new_evidence.rels[-1,:-1] = merged_row
-    new_evidence.rels[:-1,-1] = merged_col
-    new_evidence.rels[-1,-1,:] = -np.inf
-    new_evidence.rels[-1,-1,Models.cocluster] = 0
+def _sum_over_groups(rels, groups, M):
+  # For each pair of groups of variant indices into `rels`, sum the relations
+  # over all pairs of their members, returning an NxNx5 array for N groups.
+  # Each model's sums are `membership.T @ rels @ membership`, where
+  # `membership` is the MxN membership matrix. Since `rels[A,B,A_B] ==
+  # rels[B,A,B_A]`, this preserves the A_B/B_A relationship between the two
+  # triangles without swapping explicitly. The matrix is sparse, so each
+  # product costs O(M^2) rather than O(M^2 * N), and never multiplies the -inf
+  # entries on the diagonal by zero.
+  rows = [V for vidxs in groups for V in vidxs]
+  cols = [gidx for gidx, vidxs in enumerate(groups) for V in vidxs]
+  membership = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(M, len(groups)))
+
+  N = len(groups)
+  summed = np.empty((N, N, NUM_MODELS))
+  for midx in range(NUM_MODELS):
+    # Keep the sparse matrix on the left of each product.
+    summed[:,:,midx] = (membership.T @ (membership.T @ rels[:,:,midx]).T).T
+  # The diagonal holds the sum over all pairs of members, but each group
+  # should cocluster with itself with certainty.
+  diag = range(N)
+  summed[diag,diag,:] = -np.inf
+  summed[diag,diag,Models.cocluster] = 0
+  return summed
 
+def merge_variants(to_merge, evidence, logprior):
+  '''Merge each group of variant indices in `to_merge` into a single variant,
+  whose evidence against every other variant is the sum of its members'
+  evidence. Unmerged variants come first in the result, in their original
+  order, followed by the merged variants in the order of `to_merge`.'''
+  M_old = len(evidence.vids)
+  assert np.all(np.array([V for group in to_merge for V in group]) < M_old)
+  groups = [set(vidxs) for vidxs in to_merge]
+  already_merged = set()
+  for vidxs in groups:
+    assert len(vidxs & already_merged) == 0
     already_merged |= vidxs
-    evidence = new_evidence
 
-  evidence = mutrel.remove_variants_by_vidx(evidence, already_merged)
+  unmerged = [V for V in range(M_old) if V not in already_merged]
+  new_vids = [evidence.vids[V] for V in unmerged] + [','.join([evidence.vids[V] for V in vidxs]) for vidxs in groups]
+  merged = _sum_over_groups(evidence.rels, [[V] for V in unmerged] + groups, M_old)
+
+  evidence = mutrel.Mutrel(vids=new_vids, rels=merged)
   posterior = make_full_posterior(evidence, logprior)
   return (posterior, evidence)
 
-def add_variants(vids_to_add, variants, mutrel_posterior, mutrel_evidence, logprior, pbar, parallel):
+def aggregate_evidence(evidence, groups, vids):
+  '''Approximate the evidence between groups of the variants in `evidence`
+  (e.g., the clusters making up supervariants) by the mean evidence over all
+  pairs of their members, returning a mutrel with one entry per group, named by
+  `vids`. `groups` should list the variant IDs in each group.
+
+  The mean is deliberately underconfident: a supervariant pools its members'
+  reads, and so has sharper evidence than any single pair of members. (Summing
+  over pairs of members, as `merge_variants` does, is badly overconfident
+  instead.) Thus, when the approximate posterior is decisive, the exact one
+  tends to be still more decisive in the same direction.'''
+  assert len(groups) == len(vids)
+  vidxs = {vid: idx for idx, vid in enumerate(evidence.vids)}
+  missing = set([vid for group in groups for vid in group]) - set(vidxs.keys())
+  if len(missing) > 0:
+    raise Exception('Variant evidence is missing variants: %s' % ','.join(common.sort_vids(missing)))
+
+  groups = [[vidxs[vid] for vid in group] for group in groups]
+  summed = _sum_over_groups(evidence.rels, groups, len(evidence.vids))
+  sizes = np.array([len(group) for group in groups])
+  # Leave the diagonal untouched.
+  offdiag = np.logical_not(np.eye(len(groups), dtype=bool))
+  summed[offdiag] /= np.outer(sizes, sizes)[offdiag][:,None]
+  return mutrel.Mutrel(vids=list(vids), rels=summed)
+
+def calc_posterior_aggregated(variants, logprior, rel_type, approx_evidence, tol, parallel=1, method='quad', cache=None, screen=None, memo=None, tiered=None):
+  '''Compute the posterior for `variants` starting from the approximate
+  evidence in `approx_evidence` (e.g., from `aggregate_evidence`), computing
+  exact evidence only for pairs whose approximate posterior puts more than
+  `tol` probability outside its most probable relation. Returns the posterior,
+  the evidence, and a dict reporting how many pairs were refined and how far
+  the approximate posterior deviated from the exact one on those pairs.
+  '''
+  if method not in PAIR_METHODS:
+    raise Exception('Unknown pairwise method for aggregated evidence: %s' % method)
+  vids = common.extract_vids(variants)
+  assert approx_evidence.vids == vids
+  variants = [common.convert_variant_dict_to_tuple(variants[V]) for V in vids]
+  M = len(vids)
+
+  approx_posterior = make_full_posterior(approx_evidence, logprior)
+  I, J = np.triu_indices(M, 1)
+  ambiguous = 1 - np.max(approx_posterior.rels[I,J], axis=1) > tol
+  pairs = list(zip(I[ambiguous], J[ambiguous]))
+
+  posterior = mutrel.Mutrel(vids=vids, rels=np.copy(approx_posterior.rels))
+  evidence = mutrel.Mutrel(vids=vids, rels=np.copy(approx_evidence.rels))
+  _compute = lambda pbar: _compute_pairs(
+     pairs,
+     variants,
+     logprior,
+     posterior,
+     evidence,
+     pbar,
+     parallel,
+     cache = cache,
+     screen = screen,
+     memo = memo,
+     lh_method = method,
+     tiered = tiered,
+  )
+  if parallel > 0:
+    with progressbar(total=len(pairs), desc='Refining %s relations' % rel_type, unit='pair', dynamic_ncols=True) as pbar:
+      posterior, evidence = _compute(pbar)
+  else:
+    posterior, evidence = _compute(None)
+
+  refined_I, refined_J = I[ambiguous], J[ambiguous]
+  approx = approx_posterior.rels[refined_I,refined_J]
+  exact = posterior.rels[refined_I,refined_J]
+  deviation = np.max(np.abs(approx - exact), axis=1)
+  stats = {
+    'pairs': len(I),
+    'refined': len(pairs),
+    'tol': tol,
+    'max_deviation': float(np.max(deviation)) if len(pairs) > 0 else 0.,
+    'mean_deviation': float(np.mean(deviation)) if len(pairs) > 0 else 0.,
+    'argmax_changed': int(np.sum(np.argmax(approx, axis=1) != np.argmax(exact, axis=1))),
+  }
+  return (posterior, evidence, stats)
+
+def calc_posterior_partial(variants, logprior, rel_type, known_evidence, parallel=1, method='quad', cache=None, screen=None, memo=None, tiered=None):
+  '''Compute the posterior for `variants`, given `known_evidence` holding the
+  evidence already known for some pairs, and NaN for the rest. Only the
+  unknown pairs are computed, in the same orientation as `calc_posterior`, so
+  the result is identical to computing all pairs. Returns the posterior and
+  evidence.'''
+  if method not in PAIR_METHODS:
+    raise Exception('Unknown pairwise method for partial evidence: %s' % method)
+  vids = common.extract_vids(variants)
+  assert known_evidence.vids == vids
+  variants = [common.convert_variant_dict_to_tuple(variants[V]) for V in vids]
+  M = len(vids)
+
+  unknown = np.isnan(known_evidence.rels[:,:,Models.cocluster])
+  pairs = [(A, B) for A, B in itertools.combinations(range(M), 2) if unknown[A,B]] + [(V, V) for V in range(M) if unknown[V,V]]
+  evidence = mutrel.Mutrel(vids=vids, rels=np.copy(known_evidence.rels))
+  # Entries for the unknown pairs are placeholders, overwritten below.
+  placeholder = np.where(np.isnan(evidence.rels), 0, evidence.rels)
+  posterior = mutrel.Mutrel(vids=vids, rels=_calc_posterior_full(placeholder, _complete_logprior(dict(logprior))))
+  _compute = lambda pbar: _compute_pairs(
+     pairs,
+     variants,
+     logprior,
+     posterior,
+     evidence,
+     pbar,
+     parallel,
+     cache = cache,
+     screen = screen,
+     memo = memo,
+     lh_method = method,
+     tiered = tiered,
+  )
+  if parallel > 0:
+    with progressbar(total=len(pairs), desc='Computing %s relations' % rel_type, unit='pair', dynamic_ncols=True) as pbar:
+      return _compute(pbar)
+  else:
+    return _compute(None)
+
+def add_variants(vids_to_add, variants, mutrel_posterior, mutrel_evidence, logprior, pbar, parallel, cache=None, screen=None, memo=None, evidence_per_sample=None, lh_method='quad', tiered=None):
+  '''Extend `mutrel_posterior` and `mutrel_evidence` with the variants in
+  `vids_to_add`, computing relations only for pairs involving at least one new
+  variant. The relations are grown with `mutrel.grow_mutrel`, so adding
+  variants in many small waves within one process doesn't copy the whole
+  tensor each time. If
+  `evidence_per_sample` is specified, it's extended likewise, and returned
+  along with the posterior and evidence.'''
   for vid in vids_to_add:
     assert vid in variants
 
-  new_vids = mutrel_posterior.vids + vids_to_add
   # M: number of variants we have now
   # A: number of variants we added
-  M = len(new_vids)
+  M = len(mutrel_posterior.vids) + len(vids_to_add)
   A = len(vids_to_add)
   assert len(mutrel_posterior.vids) == len(mutrel_evidence.vids) == M - A
-  variants = [common.convert_variant_dict_to_tuple(variants[V]) for V in new_vids]
+  new_posterior = mutrel.grow_mutrel(mutrel_posterior, vids_to_add)
+  new_evidence = mutrel.grow_mutrel(mutrel_evidence, vids_to_add)
+  if evidence_per_sample is not None:
+    assert evidence_per_sample.vids == mutrel_evidence.vids
+    evidence_per_sample = mutrel.grow_mutrel(evidence_per_sample, vids_to_add)
+  variants = [common.convert_variant_dict_to_tuple(variants[V]) for V in new_posterior.vids]
 
-  new_posterior = mutrel.init_mutrel(new_vids)
-  new_evidence = mutrel.init_mutrel(new_vids)
-  new_posterior.rels[:-A,:-A] = mutrel_posterior.rels
-  new_evidence.rels[:-A,:-A] = mutrel_evidence.rels
+  # Compute each pair involving a new variant only once.
+  pairs = [(I, J) for J in range(M - A, M) for I in range(J + 1)]
 
-  pairs = [(I, J) for I in range(M) for J in range(M - A, M)]
-
-  return _compute_pairs(
+  posterior, evidence = _compute_pairs(
     pairs,
     variants,
     logprior,
@@ -224,12 +769,48 @@ def add_variants(vids_to_add, variants, mutrel_posterior, mutrel_evidence, logpr
     new_evidence,
     pbar,
     parallel,
+    evidence_per_sample = evidence_per_sample,
+    cache = cache,
+    screen = screen,
+    memo = memo,
+    lh_method = lh_method,
+    tiered = tiered,
   )
+  if evidence_per_sample is not None:
+    return (posterior, evidence, evidence_per_sample)
+  return (posterior, evidence)
 
-def _calc_lh_and_posterior(V1, V2, logprior):
-  evidence, evidence_per_sample = lh.calc_lh(V1, V2)
+def resolve_lh_method(method, tiered=False):
+  '''Return the per-pair method to use in place of `method`. Without Numba,
+  `quad` calls Python integrands, which is far slower, so `numpy` is used
+  instead, unless tiered integration (which needs `quad`'s error estimates) is
+  requested. Callers should resolve the method before building an
+  `evidence_cache.EvidenceCache`, so that cached evidence is keyed by the
+  method that actually computed it.'''
+  if method == 'quad' and not lh.NUMBA_AVAIL and not tiered:
+    print('Numba is unavailable, so using pairwise method numpy in place of quad', file=sys.stderr)
+    return 'numpy'
+  return method
+
+def _calc_lh_and_posterior(V1, V2, logprior, garbage=None, memo=None, lh_method='quad', tiered=None):
+  _calc_lh_base = {
+    'quad': lh.calc_lh_quad,
+    'numba': lh.calc_lh_numba,
+    'numpy': lh.calc_lh_numpy,
+  }[lh_method]
+  if lh_method == 'quad' and memo is not None:
+    _calc_lh = functools.partial(lh.calc_lh_quad, memo=memo)
+  else:
+    _calc_lh = _calc_lh_base
+
+  if tiered is not None:
+    # The fixed tier mustn't store its less precise integrals in the memo.
+    evidence, evidence_per_sample, tier = tiered.calc_lh(V1, V2, logprior, _calc_lh_base, _calc_lh, garbage)
+  else:
+    evidence, evidence_per_sample = lh.calc_lh(V1, V2, _calc_lh, garbage=garbage)
+    tier = None
   posterior = _calc_posterior(evidence, logprior)
-  return (evidence, posterior)
+  return (evidence, evidence_per_sample, posterior, tier)
 
 def _examine(V1, V2, variants, logprior=None, _calc_lh=None):
   E, Es = lh.calc_lh(*[common.convert_variant_dict_to_tuple(V) for V in (variants[V1], variants[V2])], _calc_lh)
@@ -0,0 +1,83 @@
+import hashlib
+import time
+
+import common
+import mutrel
+
+class PairwiseCheckpoint:
+  # Computing pairwise relations can take hours, so periodically store the
+  # evidence computed so far in the results archive. If the run is interrupted,
+  # the next run on the same results file restores this evidence and computes
+  # only the missing pairs. Pairs not yet computed have NaN evidence.
+  #
+  # The checkpoint is keyed by the read counts of all variants and by the
+  # settings used to compute the evidence (e.g., the pairwise method), so a
+  # checkpoint made for different variants (e.g., because clusters changed) or
+  # with different settings is discarded.
+
+  def __init__(self, results, name, interval=600):
+    self._results = results
+    self._name = name
+    self._interval = interval
+    self._last_save = time.time()
+    self._key = None
+    self.restored = 0
+
+  def _entry(self, kind):
+    return '%s_checkpoint_%s' % (self._name, kind)
+
+  def _copy_rels(self, name, dest):
+    if not self._results.has_mutrel(name):
+      return False
+    stored = self._results.get_mutrel(name)
+    if stored.vids != dest.vids or mutrel.is_packed(stored) != mutrel.is_packed(dest):
+      return False
+    if mutrel.is_packed(dest):
+      dest.rels.data[:] = stored.rels.data
+    else:
+      dest.rels[:] = stored.rels
+    return True
+
+  def _make_key(self, variants, settings):
+    H = hashlib.sha1(common.hash_variants(variants).encode('utf-8'))
+    H.update(repr(sorted(settings.items())).encode('utf-8'))
+    return H.hexdigest()
+
+  def restore(self, variants, settings, evidence, evidence_per_sample=None):
+    '''If a checkpoint exists for `variants` and `settings`, fill `evidence`
+    (and `evidence_per_sample`, if specified) in place with the checkpointed
+    values. `settings` is a dict of everything besides the variants that
+    affects the evidence. A checkpoint made for other variants or settings is
+    discarded.'''
+    self._key = self._make_key(variants, settings)
+    key_name = self._entry('key')
+    if not self._results.has(key_name):
+      return
+    if self._results.get(key_name) != self._key:
+      self.clear()
+      return
+    if evidence_per_sample is not None and not self._copy_rels(self._entry('evidence_per_sample'), evidence_per_sample):
+      return
+    self._copy_rels(self._entry('evidence'), evidence)
+
+  def update(self, evidence, evidence_per_sample=None):
+    if time.time() - self._last_save >= self._interval:
+      self.save(evidence, evidence_per_sample)
+
+  def save(self, evidence, evidence_per_sample=None):
+    assert self._key is not None
+    self._results.add(self._entry('key'), self._key)
+    self._results.add_mutrel(self._entry('evidence'), evidence)
+    if evidence_per_sample is not None:
+      self._results.add_mutrel(self._entry('evidence_per_sample'), evidence_per_sample)
+    self._results.save()
+    self._last_save = time.time()
+
+  def clear(self):
+    # Remove the checkpoint once the full tensor exists. This takes effect when
+    # the caller next saves the results, which should be when it stores the
+    # full tensor.
+    for name in ('evidence', 'evidence_per_sample'):
+      self._results.remove_mutrel(self._entry(name))
+    if self._results.has(self._entry('key')):
+      self._results.remove(self._entry('key'))
@@ -0,0 +1,159 @@
+import numpy as np
+
+from common import NUM_MODELS
+import common
+import mutrel
+import pairwise
+
+# To spread the pairwise computation across machines, the pairs (A, B) with A
+# <= B are split into `num_shards` shards, each covering a contiguous range of
+# rows A. Each shard is computed separately and written to its own results
+# file, storing only the evidence for its own pairs. `merge_shards` then
+# assembles the full evidence tensor.
+#
+# Shards are keyed by a hash of the read counts of all variants, so that shards
+# computed from different inputs can't be merged.
+
+SHARD_ENTRY = 'pairwise_shard'
+
+def parse_shard(spec):
+  '''Parse a shard spec like `3/16`, where shards are numbered from 1.'''
+  try:
+    idx, count = [int(T) for T in spec.split('/')]
+  except ValueError:
+    raise Exception('Shard must be specified as i/n, not %s' % spec)
+  if not (count >= 1 and 1 <= idx <= count):
+    raise Exception('Shard %s is out of range' % spec)
+  return (idx, count)
+
+def _make_row_bounds(M, num_shards):
+  # Row A contains M - A pairs, so choose boundaries giving each shard roughly
+  # the same number of pairs.
+  pairs_before_row = np.concatenate(([0], np.cumsum(np.arange(M, 0, -1))))
+  targets = np.linspace(0, pairs_before_row[-1], num_shards + 1)
+  bounds = np.searchsorted(pairs_before_row, targets)
+  bounds[0], bounds[-1] = 0, M
+  return bounds
+
+def make_shard_pairs(M, shard_idx, num_shards):
+  bounds = _make_row_bounds(M, num_shards)
+  rows = range(bounds[shard_idx - 1], bounds[shard_idx])
+  return np.array([(A, B) for A in rows for B in range(A, M)], dtype=int).reshape(-1, 2)
+
+def calc_shard(variants, logprior, shard, parallel=1, per_sample=False, screen=None, memo=None, lh_method='quad'):
+  '''Compute evidence for the pairs belonging to `shard`, an (index, count)
+  tuple. Returns the Nx2 array of pairs, their Nx5 evidence, and (if
+  `per_sample` is set) their NxSx5 per-sample evidence.'''
+  vids = common.extract_vids(variants)
+  variants = [common.convert_variant_dict_to_tuple(variants[V]) for V in vids]
+  logprior = pairwise._complete_logprior(dict(logprior))
+  pairs = make_shard_pairs(len(variants), *shard)
+  S = len(variants[0].omega_v)
+
+  evidence = np.nan * np.ones((len(pairs), NUM_MODELS))
+  evidence_per_sample = np.nan * np.ones((len(pairs), S, NUM_MODELS)) if per_sample else None
+  # Map each pair to its row in `evidence`.
+  pair_idxs = {(A, B): idx for idx, (A, B) in enumerate(pairs)}
+  to_compute = pairs
+  garbage_terms = pairwise._calc_garbage_terms(variants)
+
+  if screen is not None:
+    offdiag = pairs[pairs[:,0] != pairs[:,1]]
+    decisive, fast_evidence, fast_per_sample = screen.screen(offdiag, variants, garbage_terms)
+    idxs = [pair_idxs[(A, B)] for A, B in offdiag[decisive]]
+    evidence[idxs] = fast_evidence
+    if per_sample:
+      evidence_per_sample[idxs] = fast_per_sample
+    to_compute = pairs[np.isnan(evidence[:,0])]
+
+  blocks = pairwise._make_blocks([tuple(pair) for pair in to_compute], pairwise._choose_block_size(len(to_compute), parallel))
+  for block, block_evidence, _, block_per_sample, _ in pairwise._run_blocks(blocks, variants, garbage_terms, logprior, per_sample, parallel, memo, lh_method):
+    idxs = [pair_idxs[(A, B)] for A, B in block]
+    evidence[idxs] = block_evidence
+    if per_sample:
+      evidence_per_sample[idxs] = block_per_sample
+
+  assert not np.any(np.isnan(evidence))
+  return (pairs, evidence, evidence_per_sample)
+
+def write_shard(results, variants, logprior, shard, names, to_copy, parallel=1, per_sample=False, screen=None, memo=None, lh_method='quad'):
+  '''Compute `shard` of the pairwise evidence for `variants`, and store it in
+  `results`. `names` maps `evidence`, `posterior`, and `evidence_per_sample` to
+  the names under which `merge_shards` should store the merged mutrels (with
+  `posterior` being None if it shouldn't be stored). `to_copy` holds other
+  entries to store in the merged results, which must be identical across
+  shards.'''
+  pairs, evidence, evidence_per_sample = calc_shard(variants, logprior, shard, parallel, per_sample, screen, memo, lh_method)
+  vids = common.extract_vids(variants)
+  variants = [common.convert_variant_dict_to_tuple(variants[V]) for V in vids]
+
+  results.add(SHARD_ENTRY, {
+    'index': shard[0],
+    'count': shard[1],
+    'key': common.hash_variants(variants),
+    'vids': vids,
+    # The evidence doesn't depend on the prior, so don't require it to match
+    # across shards unless we'll compute the posterior.
+    'logprior': logprior if names['posterior'] is not None else None,
+    'names': names,
+    'to_copy': sorted(to_copy.keys()),
+  })
+  for K, V in to_copy.items():
+    results.add(K, V)
+  results.add('%s_pairs' % SHARD_ENTRY, pairs)
+  results.add('%s_evidence' % SHARD_ENTRY, evidence)
+  if per_sample:
+    results.add('%s_evidence_per_sample' % SHARD_ENTRY, evidence_per_sample)
+  results.save()
+
+def merge_shards(shard_results, merged):
+  '''Merge the shards stored in the `resultserializer.Results` objects in
+  `shard_results`, storing the full evidence (and posterior, if requested when
+  the shards were computed) in `merged`.'''
+  assert len(shard_results) > 0
+  metas = [R.get(SHARD_ENTRY) for R in shard_results]
+  first = metas[0]
+  for meta in metas:
+    for K in ('count', 'key', 'vids', 'logprior', 'names', 'to_copy'):
+      if meta[K] != first[K]:
+        raise Exception('Shards were computed from different inputs: %s differs' % K)
+  indices = sorted([meta['index'] for meta in metas])
+  if indices != list(range(1, first['count'] + 1)):
+    raise Exception('Expected shards 1 to %s exactly once, but got %s' % (first['count'], indices))
+
+  copied = {K: shard_results[0].get(K) for K in first['to_copy']}
+  for R in shard_results[1:]:
+    for K in first['to_copy']:
+      if R.get(K) != copied[K]:
+        raise Exception('Shards were computed from different inputs: %s differs' % K)
+
+  vids = first['vids']
+  per_sample = all([R.has('%s_evidence_per_sample' % SHARD_ENTRY) for R in shard_results])
+  evidence = mutrel.init_mutrel(vids)
+  # The posterior is recomputed below from the merged evidence, so this is a
+  # throwaway that `_store_block` requires.
+  posterior = mutrel.init_mutrel(vids)
+  if per_sample:
+    S = shard_results[0].get('%s_evidence_per_sample' % SHARD_ENTRY).shape[1]
+    evidence_per_sample = pairwise.init_evidence_per_sample(vids, S)
+  else:
+    evidence_per_sample = None
+
+  for R in shard_results:
+    pairs = R.get('%s_pairs' % SHARD_ENTRY)
+    shard_evidence = R.get('%s_evidence' % SHARD_ENTRY)
+    shard_per_sample = R.get('%s_evidence_per_sample' % SHARD_ENTRY) if per_sample else None
+    pairwise._store_block(pairs, shard_evidence, shard_evidence, shard_per_sample, evidence, posterior, evidence_per_sample)
+  if np.any(np.isnan(evidence.rels)):
+    raise Exception('Shards do not cover all pairs')
+  mutrel.check_mutrel_sanity(evidence.rels)
+
+  names = first['names']
+  for K, V in copied.items():
+    merged.add(K, V)
+  merged.add_mutrel(names['evidence'], evidence)
+  if names['posterior'] is not None:
+    merged.add_mutrel(names['posterior'], pairwise.make_full_posterior(evidence, dict(first['logprior'])))
+  if per_sample and names['evidence_per_sample'] is not None:
+    merged.add_mutrel(names['evidence_per_sample'], evidence_per_sample)
+  merged.save()
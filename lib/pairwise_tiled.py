@@ -0,0 +1,108 @@
+import json
+import os
+import numpy as np
+
+import common
+import mutrel
+import pairwise
+from progressbar import progressbar
+
+# For whole-genome data with tens of thousands of variants, even the packed
+# evidence tensor may not fit in memory. Instead, compute it in tiles of
+# contiguous rows, writing each tile to packed relations memory-mapped from a
+# file on disk (see `mutrel.create_memmap_rels`). Consumers should likewise
+# read it one tile at a time (see `mutrel.iter_row_tiles`), computing
+# posteriors from the evidence in each tile as needed, so that no posterior
+# tensor is stored.
+#
+# Alongside the relations, the directory holds `META`, recording the variants
+# the evidence is for and the number of rows completed, so an interrupted
+# computation resumes from the last completed tile. Like checkpoints, this is
+# keyed by the read counts of all variants and by the settings used to compute
+# the evidence, so evidence computed for other variants, with another method or
+# screen, or at another precision is discarded.
+
+META = 'meta.json'
+
+def _load_meta(dirname):
+  meta_fn = os.path.join(dirname, META)
+  if not os.path.exists(meta_fn):
+    return None
+  with open(meta_fn) as F:
+    return json.load(F)
+
+def _save_meta(dirname, meta):
+  # Write atomically, so an interruption can't leave a truncated file.
+  meta_fn = os.path.join(dirname, META)
+  with open(meta_fn + '.tmp', 'w') as F:
+    json.dump(meta, F)
+  os.replace(meta_fn + '.tmp', meta_fn)
+
+def _make_settings(dtype, screen, lh_method):
+  return {
+    'method': lh_method,
+    'decisive_alpha': screen.stats()['alpha'] if screen is not None else None,
+    'dtype': np.dtype(dtype).name,
+  }
+
+def _make_tile_pairs(first_row, M, tile_size):
+  # Take rows starting at `first_row` until the tile holds at least
+  # `tile_size` pairs (A, B) with A <= B.
+  last_row = first_row
+  num_pairs = 0
+  while last_row < M and num_pairs < tile_size:
+    num_pairs += M - last_row
+    last_row += 1
+  rows = np.arange(first_row, last_row)
+  A = np.repeat(rows, M - rows)
+  B = np.concatenate([np.arange(row, M) for row in rows])
+  return (last_row, np.vstack((A, B)).T)
+
+def calc_evidence_tiled(variants, dirname, parallel=1, dtype=np.float64, tile_size=2**22, screen=None, memo=None, lh_method='quad'):
+  '''Compute the pairwise evidence for `variants` in tiles of about
+  `tile_size` pairs, storing it in memory-mapped packed relations in
+  `dirname`. If `dirname` already holds evidence (or part of it) for the same
+  variants and settings, it's reused. Returns a mutrel whose relations are backed by the
+  file on disk.'''
+  vids = common.extract_vids(variants)
+  variants = [common.convert_variant_dict_to_tuple(variants[V]) for V in vids]
+  M = len(variants)
+  key = common.hash_variants(variants)
+  settings = _make_settings(dtype, screen, lh_method)
+
+  meta = _load_meta(dirname)
+  if meta is not None and meta['key'] == key and meta['vids'] == vids and meta.get('settings') == settings:
+    rels = mutrel.load_memmap_rels(dirname, mode='r+')
+  else:
+    rels = mutrel.create_memmap_rels(dirname, M, dtype)
+    meta = {'key': key, 'vids': vids, 'settings': settings, 'rows_done': 0}
+    _save_meta(dirname, meta)
+
+  garbage_terms = pairwise._calc_garbage_terms(variants)
+  # The evidence doesn't depend on the prior, and the posteriors computed
+  # along with it are discarded.
+  logprior = pairwise._complete_logprior(None)
+  rows_left = M - meta['rows_done']
+
+  with progressbar(total=M*(M + 1) // 2, desc='Computing pairwise relations', unit='pair', dynamic_ncols=True) as pbar:
+    pbar.update(M*(M + 1) // 2 - rows_left*(rows_left + 1) // 2)
+    while meta['rows_done'] < M:
+      last_row, pairs = _make_tile_pairs(meta['rows_done'], M, tile_size)
+      if screen is not None:
+        offdiag = pairs[pairs[:,0] != pairs[:,1]]
+        decisive, fast_evidence, _ = screen.screen(offdiag, variants, garbage_terms)
+        rels[offdiag[decisive,0],offdiag[decisive,1]] = fast_evidence
+        pbar.update(int(np.sum(decisive)))
+        pairs = np.vstack((offdiag[np.logical_not(decisive)], pairs[pairs[:,0] == pairs[:,1]]))
+
+      blocks = pairwise._make_blocks([tuple(pair) for pair in pairs], pairwise._choose_block_size(len(pairs), parallel))
+      for block, block_evidence, _, _, _ in pairwise._run_blocks(blocks, variants, garbage_terms, logprior, False, parallel, memo, lh_method):
+        rels[block[:,0],block[:,1]] = block_evidence
+        pbar.update(len(block))
+
+      rels.data.flush()
+      meta['rows_done'] = last_row
+      _save_meta(dirname, meta)
+
+  mutrel.check_mutrel_sanity(rels)
+  return mutrel.Mutrel(vids=vids, rels=rels)
@@ -1,22 +1,132 @@
+import collections
 import common
 import numpy as np
 import util
 
-def fit_phis(adj, superclusters, supervars, method, iterations, parallel):
-  if method == 'debug':
-    # Bypass cache when debugging.
-    return _fit_phis(adj, superclusters, supervars, method, iterations, parallel)
-  key = (hash(adj.tobytes()), iterations)
-  if key not in fit_phis.cache:
-    fit_phis.cache[key] = _fit_phis(adj, superclusters, supervars, method, iterations, parallel)
-    fit_phis.cache_misses += 1
-  else:
-    fit_phis.cache_hits += 1
-  return fit_phis.cache[key]
+class PhiCache:
+  # Chains often revisit trees they've already sampled, so remember the phi
+  # and eta fitted for each tree. Entries are keyed by the tree's parent vector
+  # itself rather than a hash of it, so that distinct trees can never collide.
+  # Once the entries exceed `max_mb`, the least recently used are evicted.
+  #
+  # As with `lh.QuadMemo`, each worker process gets its own copy of the cache,
+  # so the counts are summed by the caller (see `tree_sampler.sample_trees`).
+  #
+  # Chains in different processes also often sample the same trees. If
+  # `shared` is given, it should be a dict shared between processes (e.g., from
+  # `multiprocessing.Manager`), which is consulted on a miss, and to which each
+  # newly fitted tree is added until it holds about `shared_max_mb` of
+  # entries. Entries are never evicted from it. The first fit stored for a tree
+  # is used by every chain, so duplicate trees get identical phis.
+  #
+  # If `disk` is given, it should be a `tree_phi_cache.TreePhiCache`, which
+  # persists phis across runs. It's consulted after the shared cache, and every
+  # newly fitted tree is added to it.
+
+  def __init__(self, max_mb=256, shared=None, shared_max_mb=1024, disk=None):
+    assert max_mb > 0
+    self._max_bytes = max_mb * 2**20
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+    self._shared = shared
+    self._shared_max_bytes = shared_max_mb * 2**20
+    self._disk = disk
+    self.hits = 0
+    self.shared_hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __getstate__(self):
+    # Don't ship entries to worker processes.
+    state = dict(self.__dict__)
+    state['_entries'] = collections.OrderedDict()
+    state['_bytes'] = 0
+    return state
+
+  def _calc_size(self, key, val):
+    return len(key[0]) + sum([arr.nbytes for arr in val])
+
+  def _put_local(self, key, val):
+    if key in self._entries:
+      self._bytes -= self._calc_size(key, self._entries.pop(key))
+    self._entries[key] = val
+    self._bytes += self._calc_size(key, val)
+    while self._bytes > self._max_bytes:
+      old_key, old_val = self._entries.popitem(last=False)
+      self._bytes -= self._calc_size(old_key, old_val)
+      self.evictions += 1
+
+  def get(self, key):
+    val = self._entries.get(key)
+    if val is not None:
+      self.hits += 1
+      self._entries.move_to_end(key)
+      return val
+    if self._shared is not None:
+      val = self._shared.get(key)
+      if val is not None:
+        self.shared_hits += 1
+        self._put_local(key, val)
+        return val
+    if self._disk is not None:
+      val = self._disk.get(key)
+      if val is not None:
+        self.disk_hits += 1
+        if self._shared is not None:
+          val = self._shared.setdefault(key, val)
+        self._put_local(key, val)
+        return val
+    self.misses += 1
+    return None
+
+  def put(self, key, val):
+    # Returns the value to use for `key`, which may have been stored in the
+    # shared or disk cache by another process in the meantime.
+    if self._disk is not None:
+      val = self._disk.put(key, val)
+    # All entries are the same size, so this is a cheap check of the shared
+    # cache's size. Concurrent puts may push it slightly over.
+    if self._shared is not None and (len(self._shared) + 1) * self._calc_size(key, val) <= self._shared_max_bytes:
+      val = self._shared.setdefault(key, val)
+    self._put_local(key, val)
+    return val
+
+  def counts(self):
+    return (self.hits, self.shared_hits, self.disk_hits, self.misses, self.evictions)
+
+  def add_counts(self, hits, shared_hits, disk_hits, misses, evictions):
+    self.hits += hits
+    self.shared_hits += shared_hits
+    self.disk_hits += disk_hits
+    self.misses += misses
+    self.evictions += evictions
+
+  def stats(self):
+    total = self.hits + self.shared_hits + self.disk_hits + self.misses
+    return {
+      'hits': int(self.hits),
+      'shared_hits': int(self.shared_hits),
+      'disk_hits': int(self.disk_hits),
+      'misses': int(self.misses),
+      'hit_rate': (self.hits + self.shared_hits + self.disk_hits) / total if total > 0 else 0.,
+      'evictions': int(self.evictions),
+    }
 
-fit_phis.cache = {}
-fit_phis.cache_hits = 0
-fit_phis.cache_misses = 0
+def _make_cache_key(adj, method, iterations):
+  parents = util.convert_adjmatrix_to_parents(adj)
+  return (parents.astype(np.int64).tobytes(), method, iterations)
+
+def fit_phis(adj, superclusters, supervars, method, iterations, parallel, cache=None):
+  # Bypass cache when debugging.
+  if cache is None or method == 'debug':
+    return _fit_phis(adj, superclusters, supervars, method, iterations, parallel)
+  key = _make_cache_key(adj, method, iterations)
+  result = cache.get(key)
+  if result is None:
+    result = _fit_phis(adj, superclusters, supervars, method, iterations, parallel)
+    result = cache.put(key, result)
+  return result
 
 # Used only for `rprop_cached`.
 last_eta = ['mle']
@@ -39,12 +39,12 @@ class progressbar_file:
     self._last_printed = self._started_at
     self._print()
 
-  def update(self):
-    self._count += 1
+  def update(self, n=1):
+    self._count += n
     if self._total > -1:
       assert self._count <= self._total
 
-    if self._count == 1 or \
+    if self._count == n or \
     self._count == self._total or \
     (datetime.datetime.now() - self._last_printed).total_seconds() >= self._update_min:
       self._print()
@@ -31,6 +31,7 @@ class Results:
   def __init__(self, fn):
     self._fn = fn
     self._to_add = {}
+    self._to_remove = set()
     self._compress_type = zipfile.ZIP_LZMA
 
     if self._file_exists():
@@ -45,9 +46,11 @@ class Results:
   def _file_exists(self):
     return os.path.exists(self._fn)
 
-  def _open(self, mode='r'):
+  def _open(self, mode='r', fn=None):
     assert mode in ('r', 'w')
-    return zipfile.ZipFile(self._fn, mode, compression=self._compress_type,)
+    if fn is None:
+      fn = self._fn
+    return zipfile.ZipFile(fn, mode, compression=self._compress_type,)
 
   def has(self, name):
     return name in self._names
@@ -58,7 +61,7 @@ class Results:
         for zi in F.infolist():
           fullname = zi.filename
           name = self._resolve_name(fullname)
-          if name in self._to_add:
+          if name in self._to_add or name in self._to_remove:
             continue
           with F.open(zi) as G:
             self._to_add[name] = {
@@ -67,15 +70,21 @@ class Results:
               'timestamp': zi.date_time,
             }
 
-    with self._open('w') as F:
+    # Write to a temporary file and then move it into place, so that the
+    # existing results survive if we're killed partway through writing (e.g.,
+    # when saving a checkpoint).
+    tmp_fn = '%s.tmp%s' % (self._fn, os.getpid())
+    with self._open('w', tmp_fn) as F:
       for name, data in self._to_add.items():
         zi = zipfile.ZipInfo(
           filename=data['full_name'],
           date_time=data['timestamp'],
         )
         F.writestr(zi, data['bytes'], compress_type=self._compress_type)
+    os.replace(tmp_fn, self._fn)
 
     self._to_add = {}
+    self._to_remove = set()
 
   def add(self, name, data):
     if isinstance(data, np.ndarray):
@@ -94,17 +103,38 @@ class Results:
       'bytes': output,
     }
     self._names.add(name)
-
-  def add_mutrel(self, name, mutrel):
-    self.add('%s_vids' % name, mutrel.vids)
-    self.add('%s_rels' % name, mutrel.rels)
+    self._to_remove.discard(name)
+
+  def remove(self, name):
+    self._to_add.pop(name, None)
+    self._to_remove.add(name)
+    self._names.discard(name)
+
+  def add_mutrel(self, name, mrel):
+    self.add('%s_vids' % name, mrel.vids)
+    # Packed mutrels are stored as their packed upper triangle, without
+    # expanding to dense form.
+    if mutrel.is_packed(mrel):
+      self.add('%s_packed_rels' % name, mrel.rels.data)
+    else:
+      self.add('%s_rels' % name, mrel.rels)
 
   def get_mutrel(self, name):
-    data = self.get_many(['%s_%s' % (name, T) for T in ('vids', 'rels')])
-    return mutrel.Mutrel(vids=data['%s_vids' % name], rels=data['%s_rels' % name])
+    if self.has('%s_packed_rels' % name):
+      data = self.get_many(['%s_%s' % (name, T) for T in ('vids', 'packed_rels')])
+      rels = mutrel.PackedRels(data['%s_packed_rels' % name])
+    else:
+      data = self.get_many(['%s_%s' % (name, T) for T in ('vids', 'rels')])
+      rels = data['%s_rels' % name]
+    return mutrel.Mutrel(vids=data['%s_vids' % name], rels=rels)
+
+  def remove_mutrel(self, name):
+    for T in ('vids', 'rels', 'packed_rels'):
+      if self.has('%s_%s' % (name, T)):
+        self.remove('%s_%s' % (name, T))
 
   def has_mutrel(self, name):
-    return self.has('%s_rels' % name) and self.has('%s_vids' % name)
+    return (self.has('%s_rels' % name) or self.has('%s_packed_rels' % name)) and self.has('%s_vids' % name)
 
   def _load(self, full_name, data_type, F):
     data = F.read(full_name)
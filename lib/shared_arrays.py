@@ -0,0 +1,52 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+class SharedArrays:
+  # A set of named NumPy arrays backed by shared memory. The parent creates
+  # them with `create`, and passes `specs` to worker processes, which call
+  # `attach` to get views onto the same memory without copying.
+  #
+  # NumPy views onto the shared memory must be dropped before `close` is
+  # called, or it will fail with a BufferError.
+
+  def __init__(self):
+    self._shms = []
+    self.specs = {}
+    self.arrays = {}
+
+  def create(self, name, shape, dtype, init=None):
+    dtype = np.dtype(dtype)
+    # Shared memory can't be zero-sized.
+    size = max(1, int(np.prod(shape)) * dtype.itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    if init is not None:
+      arr[:] = init
+    self._shms.append(shm)
+    self.specs[name] = (shm.name, tuple(shape), dtype.str)
+    self.arrays[name] = arr
+    return arr
+
+  @classmethod
+  def attach(cls, specs):
+    shared = cls()
+    for name, (shm_name, shape, dtype) in specs.items():
+      shm = shared_memory.SharedMemory(name=shm_name)
+      shared._shms.append(shm)
+      shared.specs[name] = (shm_name, shape, dtype)
+      shared.arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return shared
+
+  def close(self, unlink=True):
+    self.arrays = {}
+    for shm in self._shms:
+      shm.close()
+      if unlink:
+        shm.unlink()
+    self._shms = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
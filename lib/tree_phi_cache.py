@@ -0,0 +1,105 @@
+import hashlib
+import os
+import sqlite3
+import time
+import numpy as np
+
+import common
+
+# Bump this whenever the phi fitters change, so that stale cached phis are
+# never used.
+CACHE_VERSION = 1
+
+class TreePhiCache:
+  # Phis fitted to each tree are stored in an SQLite database within
+  # `cache_dir`, keyed by a hash of the supervariants' read counts, the phi
+  # fitter and its iterations, and the tree's parent vector. Thus, runs on the
+  # same clusters (e.g., with different seeds or hyperparameters) reuse the
+  # phis of trees that earlier runs visited. SQLite handles locking, so
+  # multiple Pairtree runs, and the chains within each, can safely share a
+  # cache.
+  #
+  # Once the entries exceed `max_size_mb`, the least recently used are
+  # evicted.
+  #
+  # Each process opens its own connection to the database, so the cache can be
+  # shipped to worker processes.
+
+  def __init__(self, cache_dir, supervars, max_size_mb=1024):
+    os.makedirs(cache_dir, exist_ok=True)
+    self._db_fn = os.path.join(cache_dir, 'phis.sqlite')
+    self._db = None
+    db = self._connect()
+    db.execute('CREATE TABLE IF NOT EXISTS phis (key BLOB PRIMARY KEY, phi_eta BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)')
+    db.execute('CREATE INDEX IF NOT EXISTS phis_last_used ON phis (last_used)')
+    db.commit()
+
+    svids = common.extract_vids(supervars)
+    self._data_hash = common.hash_variants([common.convert_variant_dict_to_tuple(supervars[S]) for S in svids]).encode('utf-8')
+    self._shape = (2, len(svids) + 1, len(supervars[svids[0]]['var_reads']))
+    self._max_bytes = int(max_size_mb * 1e6)
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state['_db'] = None
+    return state
+
+  def _connect(self):
+    if self._db is None:
+      self._db = sqlite3.connect(self._db_fn, timeout=60)
+      # Let chains read while another process writes.
+      self._db.execute('PRAGMA journal_mode=WAL')
+    return self._db
+
+  def _make_key(self, key):
+    # `key` is a key from `phi_fitter.PhiCache`.
+    parents, method, iterations = key
+    H = hashlib.sha1(('%s:%s:%s:' % (CACHE_VERSION, method, iterations)).encode('utf-8'))
+    H.update(self._data_hash)
+    H.update(parents)
+    return H.digest()
+
+  def _unpack(self, blob):
+    phi_eta = np.frombuffer(blob, dtype=np.float64).reshape(self._shape)
+    return (np.copy(phi_eta[0]), np.copy(phi_eta[1]))
+
+  def get(self, key):
+    '''Return the (phi, eta) stored for `key`, or `None` if there are none.'''
+    db = self._connect()
+    db_key = self._make_key(key)
+    row = db.execute('SELECT phi_eta FROM phis WHERE key = ?', (db_key,)).fetchone()
+    if row is None:
+      return None
+    db.execute('UPDATE phis SET last_used = ? WHERE key = ?', (time.time(), db_key))
+    db.commit()
+    return self._unpack(row[0])
+
+  def put(self, key, val):
+    '''Store `val`, a (phi, eta) tuple, for `key`. If another process already
+    stored values for `key`, they're kept and returned instead, so that every
+    run uses the same phis for a tree.'''
+    db = self._connect()
+    db_key = self._make_key(key)
+    blob = np.ascontiguousarray(np.array(val), dtype=np.float64).tobytes()
+    cursor = db.execute('INSERT OR IGNORE INTO phis (key, phi_eta, size, last_used) VALUES (?, ?, ?, ?)', (db_key, blob, len(db_key) + len(blob), time.time()))
+    db.commit()
+    if cursor.rowcount == 0:
+      row = db.execute('SELECT phi_eta FROM phis WHERE key = ?', (db_key,)).fetchone()
+      if row is not None:
+        val = self._unpack(row[0])
+    else:
+      self._evict()
+    return val
+
+  def _evict(self):
+    db = self._connect()
+    total = db.execute('SELECT SUM(size) FROM phis').fetchone()[0]
+    if total is None or total <= self._max_bytes:
+      return
+    # Keep the most recently used entries that fit within the limit.
+    db.execute('''DELETE FROM phis WHERE key IN (
+      SELECT key FROM (
+        SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS cum_size FROM phis
+      ) WHERE cum_size > ?
+    )''', (self._max_bytes,))
+    db.commit()
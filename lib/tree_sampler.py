@@ -13,11 +13,16 @@ Models = common.Models
 debug = common.debug
 from common import Models, debug, NUM_MODELS
 Mutrel = mutrel.Mutrel
+PackedRels = mutrel.PackedRels
 
 from collections import namedtuple
+# Chains represent each tree by its parent vector, as `util.find_parents`
+# returns, along with the Euler tour from `_make_euler_tour` for ancestry
+# queries. Dense adjacency matrices are built only for the phi fitters.
 TreeSample = namedtuple('TreeSample', (
-  'adj',
-  'anc',
+  'parents',
+  'tour_start',
+  'tour_end',
   'phi',
   'llh_phi',
 ))
@@ -114,52 +119,79 @@ def _init_cluster_adj_mutrels(data_logmutrel):
   assert len(remaining) == 0
   return adj
 
-def _modify_tree(adj, anc, A, B):
+def _make_euler_tour(parents):
+  # Number the nodes in depth-first order from the root, returning each node's
+  # number `start` and the number `end` just past its subtree, so that `A` is
+  # an ancestor of (or is) `B` iff `start[A] <= start[B] < end[A]`.
+  K = len(parents) + 1
+  children = [[] for _ in range(K)]
+  for node, parent in enumerate(parents, 1):
+    children[parent].append(node)
+
+  order = []
+  stack = [0]
+  while len(stack) > 0:
+    node = stack.pop()
+    order.append(node)
+    stack += children[node]
+  # Nodes on a cycle are never reached from the root.
+  assert len(order) == K
+
+  size = np.ones(K, dtype=np.int)
+  for node in reversed(order[1:]):
+    size[parents[node - 1]] += size[node]
+  start = np.empty(K, dtype=np.int)
+  start[order] = np.arange(K)
+  return (start, start + size)
+
+def _is_ancestor(samp, A, B):
+  return samp.tour_start[A] <= samp.tour_start[B] < samp.tour_end[A]
+
+def _make_ancestral(samp):
+  # Equivalent to `util.make_ancestral_from_adj`, but built from the Euler
+  # tour.
+  start, end = samp.tour_start, samp.tour_end
+  return np.logical_and(start[:,None] <= start[None,:], start[None,:] < end[:,None])
+
+def _make_tree_sample(parents, __calc_phi, __calc_llh_phi):
+  tour_start, tour_end = _make_euler_tour(parents)
+  phi = __calc_phi(parents)
+  return TreeSample(
+    parents = parents,
+    tour_start = tour_start,
+    tour_end = tour_end,
+    phi = phi,
+    llh_phi = __calc_llh_phi(phi),
+  )
+
+def _modify_tree(samp, A, B):
   '''If `B` is ancestral to `A`, swap nodes `A` and `B`. Otherwise, move
-  subtree `B` under `A`.
+  subtree `B` under `A`. Returns the parent vector of the new tree.
 
   `B` can't be 0 (i.e., the root node), as we want always to preserve the
   property that node zero is root.'''
-  K = len(adj)
+  K = len(samp.parents) + 1
   # Ensure `B` is not zero.
   assert 0 <= A < K and 0 < B < K
   assert A != B
-
-  adj = np.copy(adj)
-
-  assert np.array_equal(np.diag(adj), np.ones(K))
-  # Diagonal should be 1, and every node except one of them should have a parent.
-  assert np.sum(adj) == K + (K - 1)
-  # Every column should have two 1s in it corresponding to self & parent,
-  # except for column denoting root.
-  assert np.array_equal(np.sort(np.sum(adj, axis=0)), np.array([1] + (K - 1)*[2]))
-
-  np.fill_diagonal(adj, 0)
-
-  if anc[B,A]:
-    adj_BA = adj[B,A]
-    assert anc[A,B] == adj[A,B] == 0
-    if adj_BA:
-      adj[B,A] = 0
-
-    # Swap position in tree of A and B. I need to modify both the A and B
-    # columns.
-    acol, bcol = np.copy(adj[:,A]), np.copy(adj[:,B])
-    arow, brow = np.copy(adj[A,:]), np.copy(adj[B,:])
-    adj[A,:], adj[B,:] = brow, arow
-    adj[:,A], adj[:,B] = bcol, acol
-
-    if adj_BA:
-      adj[A,B] = 1
+  parents = np.copy(samp.parents)
+
+  if _is_ancestor(samp, B, A):
+    # Swap position in tree of A and B, such that each takes the other's
+    # parent and children. If B is A's parent, A becomes B's parent.
+    A_parent, B_parent = parents[A - 1], parents[B - 1]
+    A_children, B_children = parents == A, parents == B
+    parents[A_children] = B
+    parents[B_children] = A
+    parents[A - 1] = B_parent
+    parents[B - 1] = A if A_parent == B else A_parent
     #debug('tree_permute', (A,B), 'swapping', A, B)
   else:
-    # Move B so it becomes child of A. I don't need to modify the A column.
-    adj[:,B] = 0
-    adj[A,B] = 1
+    # Move B so it becomes child of A.
+    parents[B - 1] = A
     #debug('tree_permute', (A,B), 'moving', B, 'under', A)
 
-  np.fill_diagonal(adj, 1)
-  return adj
+  return parents
 
 def calc_binom_params(supervars):
   svids = common.extract_vids(supervars)
@@ -195,11 +227,13 @@ def _scaled_softmax(A, R=100):
   B = min(1, np.log(R) / delta)
   return util.softmax(B*A)
 
-def _make_W_nodes_mutrel(adj, anc, data_logmutrel):
-  K = len(adj)
-  assert adj.shape == (K, K)
+def _make_W_nodes_mutrel(anc, data_logmutrel):
+  K = len(anc)
+  assert anc.shape == (K, K)
 
-  tree_logmutrel = _calc_tree_logmutrel(adj, data_logmutrel)
+  # First row and column will always be zero, as in `_calc_tree_logmutrel`.
+  tree_logmutrel = np.zeros((K, K))
+  tree_logmutrel[1:,1:] = _gather_logmutrel(data_logmutrel.rels, np.arange(K - 1), _calc_tree_relations(anc)[1:,1:])
   pair_error = 1 - np.exp(tree_logmutrel)
   #pair_error *= 1 - anc
 
@@ -219,8 +253,8 @@ def _make_W_nodes_mutrel(adj, anc, data_logmutrel):
 
   return weights
 
-def _make_W_nodes_uniform(adj, anc):
-  K = len(adj)
+def _make_W_nodes_uniform(anc):
+  K = len(anc)
   weights = np.ones(K)
   weights[0] = 0
   weights /= np.sum(weights)
@@ -231,10 +265,16 @@ def _make_data_logmutrel(mutrel):
   valid_models = (Models.A_B, Models.B_A, Models.diff_branches)
   invalid_models = (Models.cocluster, Models.garbage)
 
+  rels = mutrel.rels
+  if isinstance(rels, PackedRels):
+    # Packed posteriors may be stored at reduced precision, so renormalize.
+    rels = rels.to_dense()
+    rels /= np.sum(rels, axis=2)[:,:,None]
+
   alpha = common._EPSILON
-  logrels = np.full(mutrel.rels.shape, np.nan)
+  logrels = np.full(rels.shape, np.nan)
   logrels[:,:,invalid_models] = -np.inf
-  logrels[:,:,valid_models] = np.log(mutrel.rels[:,:,valid_models] + alpha)
+  logrels[:,:,valid_models] = np.log(rels[:,:,valid_models] + alpha)
 
   logrels[range(K),range(K),:] = -np.inf
   logrels[range(K),range(K),Models.cocluster] = 0
@@ -266,22 +306,82 @@ def _calc_tree_logmutrel(adj, data_logmutrel):
   assert np.all(tree_logmutrel <= 0)
   return tree_logmutrel
 
-def _make_W_dests_mutrel(subtree_head, curr_parent, adj, anc, data_logmutrel):
+def _calc_tree_relations(anc):
+  # Equivalent to `util.compute_node_relations`, but reuses the tree's
+  # existing ancestry matrix rather than rebuilding it.
+  K = len(anc)
+  anc = anc.astype(bool)
+  R = np.full((K, K), Models.diff_branches, dtype=np.int8)
+  R[anc] = Models.A_B
+  R[anc.T] = Models.B_A
+  np.fill_diagonal(R, Models.cocluster)
+  return R
+
+def _gather_logmutrel(logrels, rows, rels):
+  # Return `logrels[rows[i],j,rels[i,j]]` for every `i` and `j`.
+  return np.take_along_axis(logrels[rows], rels[:,:,None], axis=2)[:,:,0]
+
+def _calc_dest_logweights(subtree_head, anc, data_logmutrel):
+  # Compute `np.sum(np.triu(_calc_tree_logmutrel(new_adj, data_logmutrel)))`
+  # for the tree resulting from `_modify_tree(samp, dest, subtree_head)` that
+  # results from every choice of `dest`, as the current tree's sum plus the
+  # change the move makes. This takes O(K^2) time for all destinations, rather
+  # than O(K^3) from building and scoring each tree separately. Entries for
+  # `subtree_head` and its current parent are meaningless.
+  K = len(anc)
+  logrels = data_logmutrel.rels
+  # Relations between non-root nodes, indexed like `logrels`. The root's
+  # relations never contribute.
+  R = _calc_tree_relations(anc)[1:,1:]
+  B = subtree_head - 1
+  tree_logmutrel = _gather_logmutrel(logrels, np.arange(K - 1), R)
+  logweights = np.full(K, np.sum(np.triu(tree_logmutrel)))
+
+  in_subtree = anc[subtree_head,1:]
+  inside = np.flatnonzero(in_subtree)
+  outside = np.flatnonzero(np.logical_not(in_subtree))
+
+  # If `dest` is outside the subtree, moving the subtree under it changes only
+  # relations between the subtree's nodes and the others. Each other node
+  # becomes an ancestor of all of the subtree's nodes if it's an ancestor of
+  # (or is) `dest`, and is on a different branch from all of them otherwise.
+  cross = logrels[np.ix_(outside, inside)]
+  cross_diff = np.sum(cross[:,:,Models.diff_branches])
+  cross_anc_gain = np.sum(cross[:,:,Models.A_B] - cross[:,:,Models.diff_branches], axis=1)
+  cross_curr = np.sum(tree_logmutrel[np.ix_(outside, inside)])
+  dests = np.flatnonzero(np.logical_not(anc[subtree_head]))
+  logweights[dests] += cross_diff - cross_curr + np.dot(cross_anc_gain, anc[np.ix_(outside + 1, dests)])
+
+  # If `dest` is inside the subtree, it swaps places with `subtree_head`, so
+  # only their relations change: each takes on the other's relations to every
+  # other node, while `subtree_head` becomes descended from `dest`.
+  swapped = inside[inside != B]
+  if len(swapped) > 0:
+    R_swapped = R[swapped]
+    R_B = np.broadcast_to(R[B], R_swapped.shape)
+    old = _gather_logmutrel(logrels, swapped, R_swapped) + _gather_logmutrel(logrels, np.full(len(swapped), B), R_B)
+    new = _gather_logmutrel(logrels, swapped, R_B) + _gather_logmutrel(logrels, np.full(len(swapped), B), R_swapped)
+    # Pairs between `dest` and `subtree_head` are handled separately.
+    excluded = np.zeros(old.shape, dtype=bool)
+    excluded[:,B] = True
+    excluded[np.arange(len(swapped)),swapped] = True
+    old[excluded] = 0
+    new[excluded] = 0
+    delta = np.sum(new - old, axis=1)
+    delta += logrels[swapped,B,Models.A_B] - logrels[swapped,B,Models.B_A]
+    logweights[swapped + 1] += delta
+
+  return logweights
+
+def _make_W_dests_mutrel(subtree_head, curr_parent, anc, data_logmutrel):
   assert subtree_head > 0
-  assert adj[curr_parent,subtree_head] == 1
+  assert anc[curr_parent,subtree_head]
   cluster_idx = subtree_head - 1
   assert data_logmutrel.vids[cluster_idx] == 'S%s' % (cluster_idx + 1)
-  K = len(adj)
-
-  logweights = np.full(K, -np.inf)
-  for dest in range(K):
-    if dest == curr_parent:
-      continue
-    if dest == subtree_head:
-      continue
-    new_adj = _modify_tree(adj, anc, dest, subtree_head)
-    tree_logmutrel = _calc_tree_logmutrel(new_adj, data_logmutrel)
-    logweights[dest] = np.sum(np.triu(tree_logmutrel))
+
+  logweights = _calc_dest_logweights(subtree_head, anc, data_logmutrel)
+  logweights[curr_parent] = -np.inf
+  logweights[subtree_head] = -np.inf
 
   assert not np.any(np.isnan(logweights))
   valid_logweights = np.delete(logweights, (curr_parent, subtree_head))
@@ -296,8 +396,8 @@ def _make_W_dests_mutrel(subtree_head, curr_parent, adj, anc, data_logmutrel):
   weights /= np.sum(weights)
   return weights
 
-def _make_W_dests_uniform(subtree_head, curr_parent, adj, anc):
-  K = len(adj)
+def _make_W_dests_uniform(subtree_head, curr_parent, anc):
+  K = len(anc)
   weights = np.ones(K)
   weights[subtree_head] = 0
   weights[curr_parent] = 0
@@ -337,30 +437,22 @@ def _init_chain(seed, data_logmutrel, __calc_phi, __calc_llh_phi):
     init_adj = _init_cluster_adj_branching(K)
   common.ensure_valid_tree(init_adj)
 
-  init_anc = util.make_ancestral_from_adj(init_adj)
-  init_phi = __calc_phi(init_adj)
+  init_parents = util.convert_adjmatrix_to_parents(init_adj)
+  return _make_tree_sample(init_parents, __calc_phi, __calc_llh_phi)
 
-  init_samp = TreeSample(
-    adj = init_adj,
-    anc = init_anc,
-    phi = init_phi,
-    llh_phi = __calc_llh_phi(init_adj, init_phi),
-  )
-  return init_samp
-
-def _make_W_nodes_combined(adj, anc, data_logmutrel):
-  W_nodes_uniform = _make_W_nodes_uniform(adj, anc)
-  W_nodes_mutrel = _make_W_nodes_mutrel(adj, anc, data_logmutrel)
+def _make_W_nodes_combined(anc, data_logmutrel):
+  W_nodes_uniform = _make_W_nodes_uniform(anc)
+  W_nodes_mutrel = _make_W_nodes_mutrel(anc, data_logmutrel)
   return np.vstack((W_nodes_uniform, W_nodes_mutrel))
 
-def _make_W_dests_combined(subtree_head, adj, anc, data_logmutrel):
-  curr_parent = _find_parent(subtree_head, adj)
-  W_dests_uniform = _make_W_dests_uniform(subtree_head, curr_parent, adj, anc)
-  W_dests_mutrel = _make_W_dests_mutrel(subtree_head, curr_parent, adj, anc, data_logmutrel)
+def _make_W_dests_combined(subtree_head, parents, anc, data_logmutrel):
+  curr_parent = parents[subtree_head - 1]
+  W_dests_uniform = _make_W_dests_uniform(subtree_head, curr_parent, anc)
+  W_dests_mutrel = _make_W_dests_mutrel(subtree_head, curr_parent, anc, data_logmutrel)
   return np.vstack((W_dests_uniform, W_dests_mutrel))
 
 def _generate_new_sample(old_samp, data_logmutrel, __calc_phi, __calc_llh_phi):
-  K = len(old_samp.adj)
+  K = len(old_samp.parents) + 1
   # When a tree consists of two nodes (i.e., one mutation cluster), proceeding with
   # the normal sample-generating process will produce an error (specifically,
   # when we try to divide by zero in _make_W_dests_uniform). Circumvent this by
@@ -375,29 +467,24 @@ def _generate_new_sample(old_samp, data_logmutrel, __calc_phi, __calc_llh_phi):
   mode_node = _sample_cat(mode_node_weights)
   mode_dest = _sample_cat(mode_dest_weights)
 
-  W_nodes_old = _make_W_nodes_combined(old_samp.adj, old_samp.anc, data_logmutrel)
+  old_anc = _make_ancestral(old_samp)
+  W_nodes_old = _make_W_nodes_combined(old_anc, data_logmutrel)
   B = _sample_cat(W_nodes_old[mode_node])
   W_dests_old = _make_W_dests_combined(
     B,
-    old_samp.adj,
-    old_samp.anc,
+    old_samp.parents,
+    old_anc,
     data_logmutrel,
   )
 
   A = _sample_cat(W_dests_old[mode_dest])
   #A = _find_parent(B, common._true_adjm)
-  new_adj = _modify_tree(old_samp.adj, old_samp.anc, A, B)
-  new_phi = __calc_phi(new_adj)
-  new_samp = TreeSample(
-    adj = new_adj,
-    anc = util.make_ancestral_from_adj(new_adj),
-    phi = new_phi,
-    llh_phi = __calc_llh_phi(new_adj, new_phi),
-  )
+  new_parents = _modify_tree(old_samp, A, B)
+  new_samp = _make_tree_sample(new_parents, __calc_phi, __calc_llh_phi)
 
   # `A_prime` and `B_prime` correspond to the node choices needed to reverse
   # the tree perturbation.
-  if old_samp.anc[B,A]:
+  if old_anc[B,A]:
     # If `B` is ancestral to `A`, the tree perturbation swaps the nodes. Thus,
     # simply invert the swap to reverse the move.
     A_prime = B
@@ -406,20 +493,21 @@ def _generate_new_sample(old_samp, data_logmutrel, __calc_phi, __calc_llh_phi):
     # If `B` isn't ancestral to `A`, the tree perturbation moves the subtree
     # headed by `B` so that `A` becomes its parent. To reverse the move, move
     # the `B` subtree back under its old parent.
-    A_prime = _find_parent(B, old_samp.adj)
+    A_prime = old_samp.parents[B - 1]
     B_prime = B
 
-  W_nodes_new = _make_W_nodes_combined(new_samp.adj, new_samp.anc, data_logmutrel)
+  new_anc = _make_ancestral(new_samp)
+  W_nodes_new = _make_W_nodes_combined(new_anc, data_logmutrel)
   W_dests_new = _make_W_dests_combined(
     B_prime,
-    new_samp.adj,
-    new_samp.anc,
+    new_samp.parents,
+    new_anc,
     data_logmutrel,
   )
 
   if common.debug.DEBUG:
     true_parent = _find_parent(B, common._true_adjm)
-    old_parent = _find_parent(B, old_samp.adj)
+    old_parent = old_samp.parents[B - 1]
     _generate_new_sample.debug = (
       (
         B,
@@ -446,14 +534,16 @@ def _generate_new_sample(old_samp, data_logmutrel, __calc_phi, __calc_llh_phi):
   log_p_old_given_new = log_p_B_old_given_new + log_p_A_old_given_new
   return (new_samp, log_p_new_given_old, log_p_old_given_new)
 
-def _run_chain(data_logmutrel, supervars, superclusters, nsamples, thinned_frac, phi_method, phi_iterations, seed, progress_queue=None):
+def _run_chain(data_logmutrel, supervars, superclusters, nsamples, thinned_frac, phi_method, phi_iterations, seed, phi_cache, progress_queue=None):
   assert nsamples > 0
+  cache_counts = phi_cache.counts()
 
   V, N, omega_v = calc_binom_params(supervars)
-  def __calc_phi(adj):
-    phi, eta = phi_fitter.fit_phis(adj, superclusters, supervars, method=phi_method, iterations=phi_iterations, parallel=0)
+  def __calc_phi(parents):
+    adj = util.convert_parents_to_adjmatrix(parents)
+    phi, eta = phi_fitter.fit_phis(adj, superclusters, supervars, method=phi_method, iterations=phi_iterations, parallel=0, cache=phi_cache)
     return phi
-  def __calc_llh_phi(adj, phi):
+  def __calc_llh_phi(phi):
     return _calc_llh_phi(phi, V, N, omega_v)
 
   samps = [_init_chain(seed, data_logmutrel, __calc_phi, __calc_llh_phi)]
@@ -528,11 +618,11 @@ def _run_chain(data_logmutrel, supervars, superclusters, nsamples, thinned_frac,
         'accept' if accept else 'reject',
         '%.3f' % (old_samp.llh_phi / norm_phi_llh),
         '%.3f' % (new_samp.llh_phi / norm_phi_llh),
-        '%.3f' % (__calc_llh_phi(true_adj, true_phi) / norm_phi_llh),
+        '%.3f' % (__calc_llh_phi(true_phi) / norm_phi_llh),
         '%.3f' % log_p_new_given_old,
         '%.3f' % log_p_old_given_new,
-        util.find_parents(old_samp.adj),
-        util.find_parents(new_samp.adj),
+        old_samp.parents,
+        new_samp.parents,
         util.find_parents(true_adj),
         _make_W_nodes_mutrel.node_error,
       )
@@ -551,28 +641,36 @@ def _run_chain(data_logmutrel, supervars, superclusters, nsamples, thinned_frac,
   else:
     accept_rate = 1.
   assert len(samps) == expected_total_trees
+  # Report how the cache fared on this chain, so that the parent can total the
+  # counts across workers.
+  cache_counts = [after - before for before, after in zip(cache_counts, phi_cache.counts())]
   return (
-    [S.adj     for S in samps],
+    [S.parents for S in samps],
     [S.phi     for S in samps],
     [S.llh_phi for S in samps],
     accept_rate,
+    cache_counts,
   )
 
-def use_existing_structures(adjms, supervars, superclusters, phi_method, phi_iterations, parallel=0):
+def use_existing_structures(structs, supervars, superclusters, phi_method, phi_iterations, parallel=0, phi_disk_cache=None):
   V, N, omega_v = calc_binom_params(supervars)
   K = len(supervars)
   phis = []
   llhs = []
-
-  for adjm in adjms:
-    assert adjm.shape == (K+1, K+1)
-    phi, eta = phi_fitter.fit_phis(adjm, superclusters, supervars, method=phi_method, iterations=phi_iterations, parallel=parallel)
+  # The structures are given rather than revisited, so only the disk cache is
+  # useful here.
+  phi_cache = phi_fitter.PhiCache(disk=phi_disk_cache) if phi_disk_cache is not None else None
+
+  for struct in structs:
+    assert struct.shape == (K,)
+    adjm = util.convert_parents_to_adjmatrix(struct)
+    phi, eta = phi_fitter.fit_phis(adjm, superclusters, supervars, method=phi_method, iterations=phi_iterations, parallel=parallel, cache=phi_cache)
     llh = _calc_llh_phi(phi, V, N, omega_v)
     phis.append(phi)
     llhs.append(llh)
-  return (np.array(adjms), np.array(phis), np.array(llhs))
+  return (np.array(structs), np.array(phis), np.array(llhs))
 
-def sample_trees(data_mutrel, supervars, superclusters, trees_per_chain, burnin, nchains, thinned_frac, phi_method, phi_iterations, seed, parallel):
+def sample_trees(data_mutrel, supervars, superclusters, trees_per_chain, burnin, nchains, thinned_frac, phi_method, phi_iterations, seed, parallel, phi_cache_mb=256, shared_phi_cache_mb=1024, phi_disk_cache=None):
   assert nchains > 0
   assert trees_per_chain > 0
   assert 0 <= burnin <= 1
@@ -584,6 +682,7 @@ def sample_trees(data_mutrel, supervars, superclusters, trees_per_chain, burnin,
   jobs = []
   total = nchains * trees_per_chain
   data_logmutrel = _make_data_logmutrel(data_mutrel)
+  phi_cache = phi_fitter.PhiCache(phi_cache_mb, disk=phi_disk_cache)
 
   # Don't use (hard-to-debug) parallelism machinery unless necessary.
   if parallel > 0:
@@ -598,13 +697,16 @@ def sample_trees(data_mutrel, supervars, superclusters, trees_per_chain, burnin,
     # so that child processes can signal when they've sampled a tree, allowing
     # the main process to update the progress bar.
     progress_queue = manager.Queue()
+    if shared_phi_cache_mb > 0:
+      # Let chains reuse the phis fitted by chains in other processes.
+      phi_cache = phi_fitter.PhiCache(phi_cache_mb, manager.dict(), shared_phi_cache_mb, phi_disk_cache)
 
     with progressbar(total=total, desc='Sampling trees', unit='tree', dynamic_ncols=True) as pbar:
       with concurrent.futures.ProcessPoolExecutor(max_workers=parallel) as ex:
         for C in range(nchains):
           # Ensure each chain's random seed is different from the seed used to
           # seed the initial Pairtree invocation, yet nonetheless reproducible.
-          jobs.append(ex.submit(_run_chain, data_logmutrel, supervars, superclusters, trees_per_chain, thinned_frac, phi_method, phi_iterations, seed + C + 1, progress_queue))
+          jobs.append(ex.submit(_run_chain, data_logmutrel, supervars, superclusters, trees_per_chain, thinned_frac, phi_method, phi_iterations, seed + C + 1, phi_cache, progress_queue))
 
         while True:
           finished = 0
@@ -659,27 +761,29 @@ def sample_trees(data_mutrel, supervars, superclusters, trees_per_chain, burnin,
   else:
     results = []
     for C in range(nchains):
-      results.append(_run_chain(data_logmutrel, supervars, superclusters, trees_per_chain, thinned_frac, phi_method, phi_iterations, seed + C + 1))
+      results.append(_run_chain(data_logmutrel, supervars, superclusters, trees_per_chain, thinned_frac, phi_method, phi_iterations, seed + C + 1, phi_cache))
 
-  merged_adj = []
+  merged_struct = []
   merged_phi = []
   merged_llh = []
   accept_rates = []
-  for A, P, L, accept_rate in results:
-    assert len(A) == len(P) == len(L) == len(results[0][0])
-    discard_first = round(burnin * len(A))
-    merged_adj += A[discard_first:]
+  for T, P, L, accept_rate, cache_counts in results:
+    assert len(T) == len(P) == len(L) == len(results[0][0])
+    discard_first = round(burnin * len(T))
+    merged_struct += T[discard_first:]
     merged_phi += P[discard_first:]
     merged_llh += L[discard_first:]
     accept_rates.append(accept_rate)
-  assert len(merged_adj) == len(merged_phi) == len(merged_llh)
-  return (merged_adj, merged_phi, merged_llh, accept_rates)
+    if parallel > 0:
+      # Each worker had its own copy of the cache.
+      phi_cache.add_counts(*cache_counts)
+  assert len(merged_struct) == len(merged_phi) == len(merged_llh)
+  return (merged_struct, merged_phi, merged_llh, accept_rates, phi_cache.stats())
 
-def compute_posterior(adjms, phis, llhs, sort_by_llh=True):
+def compute_posterior(structs, phis, llhs, sort_by_llh=True):
   unique = {}
 
-  for A, P, L in zip(adjms, phis, llhs):
-    parents = util.find_parents(A)
+  for parents, P, L in zip(structs, phis, llhs):
     H = hash(parents.tobytes())
     if H in unique:
       assert np.isclose(L, unique[H]['llh'])
@@ -689,7 +793,8 @@ def compute_posterior(adjms, phis, llhs, sort_by_llh=True):
       # phis can arise despite the caching mechanism that stores phis for each
       # tree structure. This occurs because different chains running on
       # different cores might sample the same tree structure, but the caching
-      # mechanism is chain-specific. `projection` is not entirely
+      # mechanism is chain-specific unless the shared cache is enabled and has
+      # room for the structure. `projection` is not entirely
       # deterministic, so it may compute slightly different phis for the same
       # tree structure.
       assert np.allclose(P, unique[H]['phi'], atol=1e-5)
@@ -0,0 +1,136 @@
+import argparse
+import multiprocessing
+import numpy as np
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from progressbar import progressbar
+import common
+import inputparser
+import clustermaker
+import mutrel
+import pairwise
+import resultserializer
+
+# This must match the prior used by `bin/pairtree` for supervariants.
+LOGPRIOR = {'garbage': -np.inf, 'cocluster': -np.inf}
+# Results computed from the old clusters that are no longer valid once
+# supervariants are added. Trees must be resampled by running `bin/pairtree` on
+# the updated results. The added relations are computed with the default
+# settings, so the results can no longer be passed to `bin/pairtree
+# --reuse-results`.
+TO_REMOVE = ('struct', 'count', 'phi', 'llh', 'prob', 'accept_rate', 'clustrel_tiers', 'clustrel_settings', 'clustrel_hashes')
+
+def _add(vids_to_add, variants, evidence, logprior, parallel, posterior=None, evidence_per_sample=None):
+  # Callers may store only the evidence, in which case we rebuild the posterior
+  # from it.
+  if posterior is None:
+    posterior = pairwise.make_full_posterior(evidence, logprior)
+  M = len(evidence.vids) + len(vids_to_add)
+  num_pairs = M*(M + 1) // 2 - len(evidence.vids)*(len(evidence.vids) + 1) // 2
+  with progressbar(total=num_pairs, desc='Computing relations for added variants', unit='pair', dynamic_ncols=True) as pbar:
+    return pairwise.add_variants(
+      vids_to_add,
+      variants,
+      posterior,
+      evidence,
+      logprior,
+      pbar,
+      parallel,
+      evidence_per_sample = evidence_per_sample,
+    )
+
+def add_variants(args):
+  results = resultserializer.Results(args.pairwise_results_fn)
+  assert results.has_mutrel('evidence'), 'Pairwise evidence not present. Run bin/removegarbage with --pairwise-results.'
+  evidence = results.get_mutrel('evidence')
+  variants = inputparser.load_ssms(args.ssm_fn)
+  assert set(evidence.vids).issubset(set(variants.keys())), 'SSM file is missing variants present in the pairwise results'
+  vids_to_add = common.sort_vids(set(variants.keys()) - set(evidence.vids))
+  assert len(vids_to_add) > 0, 'No new variants to add'
+
+  dtype = evidence.rels.dtype if mutrel.is_packed(evidence) else None
+  evidence = mutrel.unpack_mutrel(evidence)
+  # The evidence doesn't depend on the prior, and `bin/removegarbage` recomputes
+  # the posterior from it with its own prior, so any prior will do.
+  _, evidence = _add(vids_to_add, variants, evidence, None, args.parallel)
+  if dtype is not None:
+    evidence = mutrel.pack_mutrel(evidence, dtype)
+  results.add_mutrel('evidence', evidence)
+  results.save()
+
+def add_supervariants(args):
+  results = resultserializer.Results(args.results_fn)
+  for K in ('clusters', 'garbage'):
+    assert results.has(K), '%s not present in results' % K
+  assert results.has_mutrel('clustrel_evidence') and results.has_mutrel('clustrel_posterior'), 'Supervariant relations not present. Run bin/pairtree with --only-build-tensor.'
+  variants = inputparser.load_ssms(args.ssm_fn)
+  params = inputparser.load_params(args.params_fn)
+  old_clusters = results.get('clusters')
+  clusters, garbage = params['clusters'], params['garbage']
+  assert clusters[:len(old_clusters)] == old_clusters, 'Existing clusters must be unchanged and listed first'
+  assert len(clusters) > len(old_clusters), 'No new clusters to add'
+  clustermaker._check_clusters(variants, clusters, garbage)
+
+  supervars = clustermaker.make_cluster_supervars(clusters, variants)
+  svids = common.extract_vids(supervars)
+  evidence = results.get_mutrel('clustrel_evidence')
+  assert evidence.vids == svids[:len(old_clusters)]
+  if results.has_mutrel('clustrel_evidence_per_sample'):
+    evidence_per_sample = results.get_mutrel('clustrel_evidence_per_sample')
+  else:
+    evidence_per_sample = None
+
+  added = _add(
+    svids[len(old_clusters):],
+    supervars,
+    evidence,
+    dict(LOGPRIOR),
+    args.parallel,
+    posterior = results.get_mutrel('clustrel_posterior'),
+    evidence_per_sample = evidence_per_sample,
+  )
+  results.add_mutrel('clustrel_posterior', added[0])
+  results.add_mutrel('clustrel_evidence', added[1])
+  if evidence_per_sample is not None:
+    results.add_mutrel('clustrel_evidence_per_sample', added[2])
+  results.add('clusters', clusters)
+  results.add('garbage', garbage)
+  for K in TO_REMOVE:
+    if results.has(K):
+      results.remove(K)
+  results.save()
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Add new variants or supervariants to the pairwise relations stored in a results file, computing only relations involving the new ones. The results file is updated in place.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+  )
+  parser.add_argument('--parallel', dest='parallel', type=int, default=None,
+    help='Number of tasks to run in parallel. By default, this is set to the number of CPU cores on the system.')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  variants_parser = subparsers.add_parser('variants',
+    help='Add variants to the pairwise evidence stored by `bin/removegarbage --pairwise-results`')
+  variants_parser.add_argument('pairwise_results_fn')
+  variants_parser.add_argument('ssm_fn',
+    help='SSM file containing all variants, both existing and new. Read counts for existing variants must be unchanged.')
+  variants_parser.set_defaults(func=add_variants)
+
+  supervars_parser = subparsers.add_parser('supervariants',
+    help='Add supervariants for new clusters to the relations stored by `bin/pairtree`. Any sampled trees are removed from the results, since they no longer apply.')
+  supervars_parser.add_argument('results_fn')
+  supervars_parser.add_argument('ssm_fn',
+    help='SSM file containing all variants, both existing and new. Read counts for existing variants must be unchanged.')
+  supervars_parser.add_argument('params_fn',
+    help='Params file whose clusters list the existing clusters first, unchanged, followed by the new clusters')
+  supervars_parser.set_defaults(func=add_supervariants)
+
+  args = parser.parse_args()
+  if args.parallel is None:
+    args.parallel = multiprocessing.cpu_count()
+  args.func(args)
+
+if __name__ == '__main__':
+  main()
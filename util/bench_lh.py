@@ -0,0 +1,54 @@
+import argparse
+import time
+import numpy as np
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import common
+import inputparser
+import lh
+import pairwise
+
+def _time_method(calc_lh, variants, pairs):
+  # Call once beforehand so that compilation isn't counted.
+  calc_lh(variants[0], variants[1])
+  start = time.perf_counter()
+  evidence = np.array([lh.calc_lh(variants[A], variants[B], calc_lh)[0] for A, B in pairs])
+  return (evidence, 1000*(time.perf_counter() - start) / len(pairs))
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Time the per-pair methods of computing pairwise evidence on random pairs of variants, and report how far their posteriors are from those of `quad`. Run with NUMBA_DISABLE_JIT=1 to time the methods as they run without Numba.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+  )
+  parser.add_argument('--pairs', dest='num_pairs', type=int, default=100,
+    help='Number of random pairs to time')
+  parser.add_argument('--seed', dest='seed', type=int, default=1,
+    help='Seed used to choose pairs')
+  parser.add_argument('ssm_fn')
+  args = parser.parse_args()
+
+  variants = inputparser.load_ssms(args.ssm_fn)
+  vids = common.extract_vids(variants)
+  variants = [common.convert_variant_dict_to_tuple(variants[V]) for V in vids]
+  assert len(variants) >= 2
+
+  np.random.seed(args.seed)
+  pairs = [np.random.choice(len(variants), size=2, replace=False) for _ in range(args.num_pairs)]
+  methods = [('quad', lh.calc_lh_quad)]
+  if lh.NUMBA_AVAIL:
+    methods.append(('numba', lh.calc_lh_numba))
+  methods.append(('numpy', lh.calc_lh_numpy))
+
+  logprior = pairwise._complete_logprior(None)
+  baseline = None
+  for name, calc_lh in methods:
+    evidence, ms_per_pair = _time_method(calc_lh, variants, pairs)
+    posterior = np.array([pairwise._calc_posterior(E, logprior) for E in evidence])
+    if baseline is None:
+      baseline = posterior
+    print('%s\t%.3f ms/pair\tmax_posterior_diff=%.3g' % (name, ms_per_pair, np.max(np.abs(posterior - baseline))))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,67 @@
+import argparse
+import numpy as np
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import lh_screen
+import pairwise
+
+def _make_variant(vid, phis, total_reads):
+  total_reads = np.array([total_reads for _ in phis])
+  var_reads = np.round(np.array(phis) * total_reads).astype(int)
+  return {
+    'id': vid,
+    'name': vid,
+    'var_reads': var_reads,
+    'ref_reads': total_reads - var_reads,
+    'total_reads': total_reads,
+    'vaf': var_reads / total_reads,
+    'omega_v': np.ones(len(phis)),
+  }
+
+# Each case gives the phis of two variants in each sample, and whether
+# `lh_screen.DecisiveScreen` should estimate their evidence in closed form.
+CASES = (
+  # A_B in every sample, with phis summing to more than one.
+  ('consistent', (0.85, 0.3), (0.9, 0.2), True),
+  # A_B in the first sample but B_A in the second, so that no tree model is
+  # consistent with both samples.
+  ('conflicting_order', (0.85, 0.3), (0.3, 0.85), False),
+  # diff_branches in the first sample but not in the second.
+  ('conflicting_branches', (0.6, 0.3), (0.85, 0.3), False),
+)
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Check that pairs screened by --decisive-alpha have the same supervariant posteriors as pairs integrated with `quad`, and that pairs whose samples disagree on their relationship are integrated rather than screened.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+  )
+  parser.add_argument('--alpha', dest='alpha', type=float, default=1e-6,
+    help='Tail mass of the credible intervals used for screening')
+  parser.add_argument('--reads', dest='total_reads', type=int, default=5000,
+    help='Total reads of each variant in each sample')
+  parser.add_argument('--tol', dest='tol', type=float, default=1e-3,
+    help='Largest allowed difference between screened and integrated posteriors')
+  args = parser.parse_args()
+
+  # This is the prior used for supervariants.
+  logprior = {'garbage': -np.inf, 'cocluster': -np.inf}
+  failed = False
+  for name, phis1, phis2, should_screen in CASES:
+    variants = {
+      'S0': _make_variant('S0', [phis1[0], phis2[0]], args.total_reads),
+      'S1': _make_variant('S1', [phis1[1], phis2[1]], args.total_reads),
+    }
+    exact, _ = pairwise.calc_posterior(variants, logprior, 'supervariant', parallel=0)
+    screen = lh_screen.DecisiveScreen(args.alpha)
+    screened, _ = pairwise.calc_posterior(variants, logprior, 'supervariant', parallel=0, screen=screen)
+
+    diff = np.max(np.abs(exact.rels - screened.rels))
+    ok = (screen.fast > 0) == should_screen and diff <= args.tol
+    failed = failed or not ok
+    print('%s\t%s\tscreened=%s\tmax_posterior_diff=%.3g' % ('ok' if ok else 'FAILED', name, screen.fast > 0, diff))
+  sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,25 @@
+import argparse
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import pairwise_shard
+import resultserializer
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Merge shards of pairwise relations computed by `bin/pairtree --only-build-tensor --shard i/n` or `bin/removegarbage --shard i/n` into a single results file. All shards must be present and must have been computed from identical inputs.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+  )
+  parser.add_argument('merged_results_fn',
+    help='Results file to write merged relations to. For Pairtree, this can then be passed to `bin/pairtree` to sample trees. For removegarbage, it can be passed via --pairwise-results.')
+  parser.add_argument('shard_results_fns', nargs='+',
+    help='Results files for each shard')
+  args = parser.parse_args()
+
+  assert args.merged_results_fn not in args.shard_results_fns
+  shard_results = [resultserializer.Results(fn) for fn in args.shard_results_fns]
+  pairwise_shard.merge_shards(shard_results, resultserializer.Results(args.merged_results_fn))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,121 @@
+import argparse
+import multiprocessing
+import numpy as np
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import inputparser
+import clustermaker
+import pairwise
+import resultserializer
+
+# This must match the prior used by `bin/pairtree` for supervariants.
+LOGPRIOR = {'garbage': -np.inf, 'cocluster': -np.inf}
+# These are the only results that remain valid once the samples change. Tree
+# structures and phis must be recomputed by running `bin/pairtree` on the
+# output.
+TO_COPY = ('clusters', 'garbage')
+
+def _filter_samples(variants, samp_idxs):
+  filtered = {}
+  for vid, V in variants.items():
+    # Duplicate so as to not modify original.
+    filtered[vid] = dict(V)
+    for K in ('var_reads', 'ref_reads', 'total_reads', 'omega_v', 'vaf'):
+      filtered[vid][K] = V[K][samp_idxs]
+  return filtered
+
+def _write_results(in_results, out_results_fn, sampnames, evidence_per_sample):
+  evidence = pairwise.sum_evidence_per_sample(evidence_per_sample)
+  posterior = pairwise.make_full_posterior(evidence, dict(LOGPRIOR))
+
+  out_results = resultserializer.Results(out_results_fn)
+  for K in TO_COPY:
+    out_results.add(K, in_results.get(K))
+  out_results.add('sampnames', sampnames)
+  out_results.add_mutrel('clustrel_evidence_per_sample', evidence_per_sample)
+  out_results.add_mutrel('clustrel_evidence', evidence)
+  out_results.add_mutrel('clustrel_posterior', posterior)
+  out_results.save()
+
+def _load(results_fn):
+  results = resultserializer.Results(results_fn)
+  assert results.has_mutrel('clustrel_evidence_per_sample'), 'Per-sample evidence not present. Run bin/pairtree with --keep-sample-evidence.'
+  sampnames = results.get('sampnames')
+  evidence_per_sample = results.get_mutrel('clustrel_evidence_per_sample')
+  assert evidence_per_sample.rels.shape[2] == len(sampnames)
+  return (results, sampnames, evidence_per_sample)
+
+def subset(args):
+  results, sampnames, evidence_per_sample = _load(args.in_results_fn)
+  to_keep = args.samples.split(',')
+  assert len(to_keep) > 0 and set(to_keep).issubset(set(sampnames))
+  samp_idxs = [sampnames.index(S) for S in to_keep]
+
+  evidence_per_sample = evidence_per_sample._replace(rels=evidence_per_sample.rels[:,:,samp_idxs])
+  _write_results(results, args.out_results_fn, to_keep, evidence_per_sample)
+
+def add(args):
+  results, sampnames, evidence_per_sample = _load(args.in_results_fn)
+  variants = inputparser.load_ssms(args.ssm_fn)
+  params = inputparser.load_params(args.params_fn)
+  new_sampnames = params['samples']
+  assert set(sampnames).issubset(set(new_sampnames))
+  assert len(new_sampnames) == len(variants[next(iter(variants))]['var_reads'])
+
+  added = [S for S in new_sampnames if S not in sampnames]
+  assert len(added) > 0, 'No new samples to add'
+  variants = _filter_samples(variants, [new_sampnames.index(S) for S in added])
+
+  parallel = args.parallel if args.parallel is not None else multiprocessing.cpu_count()
+  # Supervariants are constructed independently in each sample, so building
+  # them only from the new samples gives the same read counts as building them
+  # from all samples.
+  built = clustermaker.use_pre_existing(
+    variants,
+    dict(LOGPRIOR),
+    parallel,
+    results.get('clusters'),
+    results.get('garbage'),
+    pairwise_args = {'per_sample': True},
+  )
+  added_per_sample = built[5]
+
+  combined = pairwise.concat_evidence_per_sample(evidence_per_sample, added_per_sample)
+  order = [(sampnames + added).index(S) for S in new_sampnames]
+  combined = combined._replace(rels=combined.rels[:,:,order])
+  _write_results(results, args.out_results_fn, new_sampnames, combined)
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Rebuild the supervariant pairwise relations in a Pairtree results file for a different set of samples, using per-sample evidence stored by `bin/pairtree --keep-sample-evidence`. The output contains only the pairwise relations, and can be passed to `bin/pairtree` to sample trees.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+  )
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  subset_parser = subparsers.add_parser('subset',
+    help='Keep only the listed samples, without any recomputation')
+  subset_parser.add_argument('--samples', required=True,
+    help='Comma-separated names of samples to keep, in the order they should appear')
+  subset_parser.add_argument('in_results_fn')
+  subset_parser.add_argument('out_results_fn')
+  subset_parser.set_defaults(func=subset)
+
+  add_parser = subparsers.add_parser('add',
+    help='Add new samples, computing evidence only for those samples')
+  add_parser.add_argument('--parallel', dest='parallel', type=int, default=None,
+    help='Number of tasks to run in parallel. By default, this is set to the number of CPU cores on the system.')
+  add_parser.add_argument('in_results_fn')
+  add_parser.add_argument('ssm_fn',
+    help='SSM file containing read counts for all samples, both existing and new')
+  add_parser.add_argument('params_fn',
+    help='Params file listing names of all samples, both existing and new')
+  add_parser.add_argument('out_results_fn')
+  add_parser.set_defaults(func=add)
+
+  args = parser.parse_args()
+  args.func(args)
+
+if __name__ == '__main__':
+  main()